@@ -16,15 +16,30 @@
 
 import adsk.core, adsk.fusion, adsk.cam, traceback
 
-from collections import defaultdict
+import base64
+from collections import OrderedDict, defaultdict, deque
+import hashlib
 import json
 import os
 import sys
+import tempfile
 import threading
+import time
+import weakref
+import zlib
+
+# Start of the add-in load, for startup_timing
+LOAD_START_TIME = time.perf_counter()
+# Milliseconds spent loading the module ('import-ms') and in run() ('run-ms')
+startup_timing = {}
 
 NAME = 'Vertical Timeline'
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# The library has already been imported if the add-in is started again in the
+# same Fusion session, e.g. during development. A first import is always fresh.
+reload_lib = f'{__package__}.thomasa88lib' in sys.modules
+
 # Import relative path to avoid namespace pollution
 from .thomasa88lib import utils
 from .thomasa88lib import events
@@ -34,29 +49,75 @@ from .thomasa88lib import manifest
 from .thomasa88lib import error
 
 # Force modules to be fresh during development
-import importlib
-importlib.reload(thomasa88lib)
-importlib.reload(thomasa88lib.events)
-importlib.reload(thomasa88lib.timeline)
-importlib.reload(thomasa88lib.settings)
-importlib.reload(thomasa88lib.manifest)
-importlib.reload(thomasa88lib.error)
+if reload_lib:
+    import importlib
+    importlib.reload(thomasa88lib)
+    importlib.reload(thomasa88lib.events)
+    importlib.reload(thomasa88lib.timeline)
+    importlib.reload(thomasa88lib.settings)
+    importlib.reload(thomasa88lib.manifest)
+    importlib.reload(thomasa88lib.error)
 
 ui = None
 app = None
 error_catcher = thomasa88lib.error.ErrorCatcher(msgbox_in_debug=False)
 events_manager = thomasa88lib.events.EventsManager(error_catcher)
-manifest = thomasa88lib.manifest.read()
+# Read on first use, see get_manifest()
+manifest_data = None
 
 html_ready = False
+# The palette shows a timeline from the disk cache, that has not been
+# checked against the design yet
+palette_stale = False
+# Names of the groups that are collapsed in the palette. The objects in them
+# are sent without their details, like with lazy details.
+palette_collapsed_groups = set()
 
 timeline_item_count = 0
 timeline_marker_position = -1
 
 settings = thomasa88lib.settings.SettingsManager(
-    { 'enabled': False }
+    {
+        'enabled': False,
+        # Wait for commands to stop coming before refreshing. 0 disables the delay.
+        'refresh_delay_ms': 150,
+        # Don't let a long burst of commands delay the refresh more than this.
+        'refresh_max_delay_ms': 1000,
+        # Send the timeline in the compact format (see encode_compact_rows)
+        'compact_timeline': True,
+        # Send large timelines in chunks of this many rows. 0 disables chunking.
+        'stream_chunk_size': 500,
+        # For timelines with more items than this, only names and states are
+        # sent up front. Types, images and parents are fetched by the palette
+        # for the rows it shows. -1 disables this.
+        'lazy_details_threshold': 1000,
+        # Time the refreshes and show the timings in the palette (Ctrl+Shift+P)
+        'profiling': False,
+        # Skip the refresh after commands that did not change the timeline
+        # (see RefreshGate)
+        'refresh_gate': True,
+        # Prepare the selection of the rows in view, so that clicking a row
+        # does not have to wait for Fusion (see SelectionPrewarmer)
+        'prewarm_selection': True,
+        # Keep the timelines of this many documents in memory, to show them
+        # right away when switching back (see DocumentCache). 0 disables it.
+        'document_cache_size': 4,
+        # The total number of timeline rows that the document cache may hold
+        'document_cache_max_rows': 100000,
+        # Keep the last shown timeline of saved documents on disk, to show it
+        # right away when the document is first shown in a session (see DiskCache)
+        'disk_cache': False,
+        # The total size of the files in the disk cache
+        'disk_cache_max_mb': 50,
+    }
 )
 
+def get_manifest():
+    global manifest_data
+    if manifest_data is None:
+        manifest_data = thomasa88lib.manifest.read()
+    return manifest_data
+
 def get_enabled():
     return settings['enabled']
 
@@ -103,7 +164,7 @@ FEATURE_RESOURCE_MAP = {
     'FormFeature': ('Fusion/UI/FusionUI/Resources/TSpline/TSplineBaseFeatureCreation', 'TSplineBaseFeatureActivate'),
     'LoftFeature': lambda i: ('Fusion/UI/FusionUI/Resources/solid/loft', 'FusionLoftEditCommand') if i.entity.isSolid else ('Fusion/UI/FusionUI/Resources/surface/loft', 'FusionSurfaceLoftEditCommand'),
     'ExtrudeFeature': lambda i: ('Fusion/UI/FusionUI/Resources/solid/extrude', 'FusionExtrudeEditCommand') if i.entity.isSolid else ('Fusion/UI/FusionUI/Resources/surface/extrude', 'FusionSurfaceExtrudeEditCommand'),
-    'Occurrence': lambda i: OCCURRENCE_RESOURCE_MAP[thomasa88lib.timeline.get_occurrence_type(i)],
+    'Occurrence': lambda i: OCCURRENCE_RESOURCE_MAP[i.occurrence_type],
     'BoundaryFillFeature': ('Fusion/UI/FusionUI/Resources/surface/surface_sculpt', 'FusionSculptEditCommand'),
     'SurfaceDeleteFaceFeature': ('Fusion/UI/FusionUI/Resources/modify/surface_delete', 'FusionDcSurfaceDeleteFaceEditCommand'),
     'RevolveFeature': lambda i: ('Fusion/UI/FusionUI/Resources/solid/revolve', 'FusionRevolveEditCommand') if i.entity.isSolid else ('Fusion/UI/FusionUI/Resources/surface/revolve', 'FusionSurfaceRevolveEditCommand'),
@@ -172,40 +233,205 @@ FEATURE_RESOURCE_MAP = {
     # insert derive feature: 'Fusion/UI/FusionUI/Resources/Derive/CloneWM',
 }
 
-def get_feature_image(obj):
-    match = get_feature_res(obj)
+# Images that are not found through the resource maps
+UNMAPPED_IMAGE = 'Fusion/UI/FusionUI/Resources/finish/finishX'
+GROUP_IMAGE = 'Fusion/UI/FusionUI/Resources/Timeline/GroupFeature'
+INSERT_DERIVE_IMAGE = 'Fusion/UI/FusionUI/Resources/Derive/CloneWM'
+ACCESS_ERROR_IMAGE = 'Fusion/UI/FusionUI/Resources/TSpline/Error'
+
+_UNREAD = object()
+
+class TimelineObjectInfo:
+    '''Attributes of a timeline object, read from Fusion at most once.
+
+    Each API call is slow, so this is used in place of the timeline object
+    when walking the timeline. The values are not updated, so create new
+    ones for each pass.'''
+    def __init__(self, obj):
+        self.obj = obj
+        self._name = _UNREAD
+        self._is_suppressed = _UNREAD
+        self._is_rolled_back = _UNREAD
+        self._entity = _UNREAD
+        self._entity_type = _UNREAD
+        self._component = _UNREAD
+        self._occurrence_type = _UNREAD
+        self._res = _UNREAD
+
+    @property
+    def name(self):
+        if self._name is _UNREAD:
+            self._name = self.obj.name
+        return self._name
+
+    @property
+    def is_suppressed(self):
+        if self._is_suppressed is _UNREAD:
+            self._is_suppressed = self.obj.isSuppressed
+        return self._is_suppressed
+
+    @property
+    def is_rolled_back(self):
+        if self._is_rolled_back is _UNREAD:
+            self._is_rolled_back = self.obj.isRolledBack
+        return self._is_rolled_back
+
+    @property
+    def entity(self):
+        '''The entity, or None if Fusion does not give access to it.'''
+        if self._entity is _UNREAD:
+            try:
+                self._entity = self.obj.entity
+            except RuntimeError:
+                # Move and Align and more does not allow us to access their entity attribute
+                # Bug: https://forums.autodesk.com/t5/fusion-360-api-and-scripts/api-bug-cannot-access-entity-of-quot-move-quot-feature/m-p/9651921
+                self._entity = None
+        return self._entity
+
+    @property
+    def entity_type(self):
+        if self._entity_type is _UNREAD:
+            self._entity_type = thomasa88lib.utils.short_class(self.entity)
+        return self._entity_type
+
+    @property
+    def component(self):
+        '''The component of an occurrence entity.'''
+        if self._component is _UNREAD:
+            self._component = self.entity.component
+        return self._component
+
+    @property
+    def occurrence_type(self):
+        if self._occurrence_type is _UNREAD:
+            self._occurrence_type = thomasa88lib.timeline.get_occurrence_type(self.obj)
+        return self._occurrence_type
+
+    @property
+    def res(self):
+        '''(image, edit command ID) of the entity, or None.'''
+        if self._res is _UNREAD:
+            self._res = get_feature_res(self)
+        return self._res
+
+def get_feature_image(info):
+    match = info.res
 
     if not match or not match[0]:
         # Image not mapped
-        image = 'Fusion/UI/FusionUI/Resources/finish/finishX'
+        image = UNMAPPED_IMAGE
     else:
         image = match[0]
     
-    return get_image_path(image)
+    return get_image_key(image)
 
-def get_feature_edit_command_id(obj):
-    match = get_feature_res(obj)
+def get_feature_edit_command_id(info):
+    match = info.res
 
     if not match or not match[1]:
         return None
     else:
         return match[1]
 
-def get_feature_res(obj):
-    entity = obj.entity
-    fusionType = thomasa88lib.utils.short_class(entity)
-    match = FEATURE_RESOURCE_MAP.get(fusionType)
+def get_feature_res(info):
+    match = FEATURE_RESOURCE_MAP.get(info.entity_type)
     if callable(match):
-        match = match(obj)
+        match = match(info)
     return match
 
-def get_image_path(subpath):
-    path = f'{thomasa88lib.utils.get_fusion_deploy_folder()}/{subpath}/16x16.png'
-    if os.path.exists(path):
-        return path
-    else:
-        print(f'File does not exist: {path}')
+class ImageIndex:
+    '''Resolved image paths for one deploy folder.
+
+    Holds None for images that do not exist, so that they are only looked
+    for once.
+
+    Rows refer to images by their subpath (the image key). The palette gets
+    the images as data URIs, through get_icons(), so that it does not have
+    to load any image files.'''
+    def __init__(self, deploy_folder):
+        self.deploy_folder = deploy_folder
+        self.paths = {}
+        # Image key -> data URI, or None
+        self.data_uris = {}
+
+    def get_data_uri(self, subpath):
+        try:
+            return self.data_uris[subpath]
+        except KeyError:
+            pass
+        path = self.paths[subpath] if subpath in self.paths else self.resolve(subpath)
+        data_uri = None
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    data_uri = 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+            except OSError as e:
+                print(f'Failed to read {path}: {e}')
+        self.data_uris[subpath] = data_uri
+        return data_uri
+
+    def resolve(self, subpath):
+        path = f'{self.deploy_folder}/{subpath}/16x16.png'
+        if os.path.exists(path):
+            resolved = path
+        else:
+            print(f'File does not exist: {path}')
+            resolved = None
+        self.paths[subpath] = resolved
+        return resolved
+
+image_index = None
+
+def update_image_index():
+    '''Makes sure the image index matches the current deploy folder.
+    Call once per refresh, before calling get_image_key().'''
+    global image_index
+    deploy_folder = thomasa88lib.utils.get_fusion_deploy_folder()
+    if image_index and image_index.deploy_folder == deploy_folder:
+        return image_index
+
+    image_index = ImageIndex(deploy_folder)
+    for subpath in get_mapped_image_subpaths():
+        image_index.resolve(subpath)
+    return image_index
+
+def get_mapped_image_subpaths():
+    # Images returned by the lambdas in FEATURE_RESOURCE_MAP are not known
+    # until they are called. They are resolved on first use instead.
+    subpaths = { UNMAPPED_IMAGE, GROUP_IMAGE, INSERT_DERIVE_IMAGE, ACCESS_ERROR_IMAGE }
+    for resource_map in (FEATURE_RESOURCE_MAP, PLANE_RESOURCE_MAP, OCCURRENCE_RESOURCE_MAP):
+        for res in resource_map.values():
+            if not callable(res) and res[0]:
+                subpaths.add(res[0])
+    return subpaths
+
+def get_image_key(subpath):
+    '''Returns the key of the image to show for subpath, or None if the
+    image does not exist.'''
+    index = image_index or update_image_index()
+    try:
+        path = index.paths[subpath]
+    except KeyError:
+        path = index.resolve(subpath)
+    return subpath if path else None
+
+def get_icons(keys):
+    '''Returns the data URIs of the images, by image key. None for images
+    that could not be read.'''
+    index = image_index or update_image_index()
+    return { key: index.get_data_uri(key) for key in keys }
+
+def make_icons_command():
+    '''Returns a command with the icons of the rows in the snapshot, to send
+    before the timeline, so that the rows get their icons from the start.
+    The palette asks for any other icons when it needs them.'''
+    if timeline_snapshot is None:
+        return None
+    keys = { row.get('image') for row in timeline_snapshot.rows }
+    keys.discard(None)
+    if not keys:
         return None
+    return {'action': 'setIcons', 'data': get_icons(keys)}
 
 def find_commands(substring):
     return [c.id for c in ui.commandDefinitions if substring in c.id.lower()]
@@ -223,25 +449,136 @@ def find_commands_by_resource_folder(folder):
 # ui.commandDefinitions.itemById('').resourceFolder
 # design.rootComponent.allOccurrences[0].component.sketches
 
-def invalidate(send=True, clear=False):
+PROFILE_HISTORY_LENGTH = 100
+
+class RefreshProfile:
+    def __init__(self, kind):
+        self.kind = kind
+        self.start = time.perf_counter()
+        self.last = self.start
+        # [phase name, milliseconds]
+        self.phases = []
+        self.counts = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append([phase, round((now - self.last) * 1000, 3)])
+        self.last = now
+
+class RefreshProfiler:
+    '''Times the phases of refreshes, when the profiling setting is on.
+
+    Call mark() at the end of each phase. When profiling is off, no profile
+    is created and the calls return right away.'''
+    def __init__(self):
+        self.current = None
+        self.history = deque(maxlen=PROFILE_HISTORY_LENGTH)
+        # Timings reported by the palette
+        self.html_history = deque(maxlen=PROFILE_HISTORY_LENGTH)
+        self.next_seq = 0
+
+    def begin(self, kind):
+        self.current = RefreshProfile(kind) if settings['profiling'] else None
+
+    def mark(self, phase):
+        if self.current:
+            self.current.mark(phase)
+
+    def count(self, key, value):
+        if self.current:
+            self.current.counts[key] = value
+
+    def end(self):
+        profile = self.current
+        if not profile:
+            return
+        self.current = None
+        self.history.append({
+            'seq': self.next_seq,
+            'kind': profile.kind,
+            'time': round(time.time() * 1000),
+            'total-ms': round((profile.last - profile.start) * 1000, 3),
+            'phases': profile.phases,
+            'counts': profile.counts,
+        })
+        self.next_seq += 1
+
+    def get_entries(self, since_seq):
+        return [entry for entry in self.history if entry['seq'] >= since_seq]
+
+    def export(self):
+        path = os.path.join(tempfile.gettempdir(), 'VerticalTimeline-profile.json')
+        with open(path, 'w') as f:
+            json.dump({
+                'version': get_manifest()['version'],
+                'startup': startup_timing,
+                'refreshes': list(self.history),
+                'palette': list(self.html_history),
+                'counters': get_cache_counters(),
+            }, f, indent=1)
+        return path
+
+refresh_profiler = RefreshProfiler()
+
+def get_cache_counters():
+    '''Returns the hit/miss counters of the caches, for the profile.'''
+    return {
+        'refresh-gate': refresh_gate.counters,
+        'document-cache': document_cache.counters,
+        'disk-cache': disk_cache.counters,
+    }
+
+def invalidate(send=True, clear=False, marker_only=False):
+    '''Updates the palette with the current timeline.
+
+    marker_only tells that the change is expected to only have moved the
+    timeline marker. If so, only the rows around the old and new marker
+    positions are checked.'''
     global timeline_item_count
     global timeline_marker_position
     global html_ready
+    global palette_stale
 
     palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
 
     if not palette or not html_ready:
         return
 
+    refresh_profiler.begin('refresh')
     message = ""
     features = []
     max_parents = 0
+    html_command = None
+    marker_command = None
+    refresh_details = False
+    # Whatever was being sent is outdated
+    timeline_stream.cancel()
+    recheck_component_hierarchy()
     if not clear:
         timeline_status, timeline = thomasa88lib.timeline.get_timeline()
+        refresh_profiler.mark('timeline')
         if timeline_status == TIMELINE_STATUS_OK:
-            timeline_item_count = timeline.count
-            timeline_marker_position = timeline.markerPosition
-            features, max_parents = get_features(timeline)
+            item_count = timeline.count
+            marker_position = timeline.markerPosition
+            details = not use_lazy_details(timeline)
+            if (marker_only and timeline_snapshot is not None and
+                item_count == timeline_item_count and
+                marker_position != timeline_marker_position):
+                marker_command = make_marker_command(timeline_marker_position, marker_position, details)
+            timeline_item_count = item_count
+            timeline_marker_position = marker_position
+            if marker_command is not None:
+                html_command = marker_command
+            else:
+                update_image_index()
+                if timeline_snapshot is None and timeline_stream.should_stream(timeline):
+                    # Nothing to patch. Show the first rows while walking the rest.
+                    html_command = timeline_stream.begin(timeline, details)
+                else:
+                    features, max_parents = get_features(timeline, details)
+                    # The rows lack the details, so edits that only change
+                    # them, e.g. solid to surface, do not show in the patch
+                    refresh_details = not details
         elif timeline_status == TIMELINE_STATUS_PRODUCT_NOT_READY:
             timeline_item_count = -1
             timeline_marker_position = -1
@@ -252,196 +589,911 @@ def invalidate(send=True, clear=False):
         else:
             print("Unhandled timeline status:", timeline_status)
 
-    action = 'setTimeline'
-    data = {
-         'features': features,
-         'max-parents': max_parents,
-         'message': message,
-    }
+    if html_command is None:
+        html_command = make_timeline_command(features, max_parents, message)
+        refresh_profiler.mark('command')
+    if palette_stale:
+        palette_stale = False
+        if html_command is None:
+            # The timeline from the disk cache was right
+            html_command = {'action': 'confirmTimeline', 'data': {}}
+    if refresh_details:
+        feature_details_cache.clear()
+        if html_command is None:
+            html_command = {'action': 'refreshDetails', 'data': {}}
+        elif html_command['action'] == 'patchTimeline':
+            html_command['data']['refresh-details'] = True
+    if refresh_profiler.current and timeline_cache_map:
+        refresh_profiler.count('items', len(timeline_cache_map) - 1)
 
     if not send:
         # Cannot do sendInfoToHTML inside the HTML event handler. We either have to use htmlArgs.returnData or
         # spawn a thread (does not seem very safe? Can we call into the event loop instead?).
-        html_command = {'action': 'setTimeline', 'data': data}
+        # The profile is ended by the caller, after encoding the JSON.
         return html_command
+    elif html_command:
+        json_data = json.dumps(html_command['data'])
+        refresh_profiler.mark('json')
+        palette.sendInfoToHTML(html_command['action'], json_data)
+        refresh_profiler.mark('send')
+        refresh_profiler.count('bytes', len(json_data))
+    refresh_profiler.end()
+
+class TimelineSnapshot:
+    def __init__(self, rows, max_parents, message):
+        self.rows = rows
+        self.max_parents = max_parents
+        self.message = message
+
+# The rows last sent to the palette. Used to only send the changes.
+timeline_snapshot = None
+
+def make_timeline_command(features, max_parents, message):
+    global timeline_snapshot
+    snapshot = TimelineSnapshot(flatten_features(features), max_parents, message)
+    old_snapshot = timeline_snapshot
+    timeline_snapshot = snapshot
+
+    if (old_snapshot and
+        old_snapshot.max_parents == snapshot.max_parents and
+        old_snapshot.message == snapshot.message):
+        patch = diff_snapshot_rows(old_snapshot.rows, snapshot.rows)
+        if patch is not None:
+            if patch_is_empty(patch):
+                # Nothing to tell the palette
+                return None
+            if 'tail-ids' in patch:
+                # IDs have moved
+                feature_details_cache.clear()
+            else:
+                # The kept rows are the same objects, with the same details
+                start = patch['start']
+                changed_rows = [row for _, row in patch['update']]
+                changed_rows += [row for row in patch['insert'] if not row.get('keep')]
+                changed_rows += old_snapshot.rows[start:start + patch['remove-count']]
+                kept_ids = { row['id'] for row in patch['insert'] if row.get('keep') }
+                for row in changed_rows:
+                    if row['id'] not in kept_ids:
+                        feature_details_cache.pop(row['id'], None)
+            return {'action': 'patchTimeline', 'data': patch}
+
+    # No previous state to patch against or the change is too big. Send everything.
+    feature_details_cache.clear()
+    return make_set_timeline_command(snapshot, features)
+
+def make_set_timeline_command(snapshot, features=None):
+    '''Returns a command that replaces the whole palette timeline with the
+    snapshot. features is the snapshot as a tree, if available.'''
+    data = {
+        'max-parents': snapshot.max_parents,
+        'message': snapshot.message,
+    }
+    if settings['compact_timeline']:
+        data['format'] = 'compact'
+        data.update(encode_compact_rows(snapshot.rows))
     else:
-        palette.sendInfoToHTML('setTimeline', json.dumps(data))
+        data['features'] = features if features is not None else unflatten_rows(snapshot.rows)
+    return {'action': 'setTimeline', 'data': data}
+
+def get_snapshot_marker_row(rows, marker_position):
+    '''Returns the row of the timeline object at marker_position. Groups
+    are not counted by the marker.'''
+    item_index = 0
+    for i, row in enumerate(rows):
+        if row.get('type') != 'GROUP':
+            if item_index == marker_position:
+                return i
+            item_index += 1
+    return len(rows)
+
+def make_marker_command(old_position, new_position, details):
+    '''Returns a command that moves the marker in the palette, by only
+    reading the rows that can have been rolled back or forward.
+
+    Returns None if no row has changed, to have the caller check the whole
+    timeline.'''
+    rows = timeline_snapshot.rows
+    first_row = get_snapshot_marker_row(rows, min(old_position, new_position))
+    last_row = get_snapshot_marker_row(rows, max(old_position, new_position))
+    # Include the rows next to the range, in case the marker is at a group
+    check_rows = set(range(max(0, first_row - 1), min(len(rows), last_row + 1)))
+
+    # Groups are rolled back when all their children are
+    row_indexes = { row['id']: i for i, row in enumerate(rows) if row.get('type') == 'GROUP' }
+    for i in list(check_rows):
+        group = rows[i]['group']
+        while group is not None:
+            check_rows.add(row_indexes[group])
+            group = rows[row_indexes[group]]['group']
+
+    rolled_back = []
+    updates = []
+    component_hierarchy = None
+    for i in sorted(check_rows):
+        row = rows[i]
+        node = timeline_cache_map.get(int(row['id'])) if timeline_cache_map else None
+        if not node or not node.obj:
+            return None
+        is_rolled_back = node.obj.isRolledBack
+        if is_rolled_back == row['rolledBack']:
+            continue
+        # The bodies of a feature depend on if it is rolled back
+        node.selection = None
+        # Lazily loaded rows only have their type in the details cache
+        if feature_details_cache.get(row['id'], row).get('type') == 'Occurrence':
+            # The component path of an occurrence depends on if it is rolled back
+            feature_details_cache.pop(row['id'], None)
+            if details and component_hierarchy is None:
+                component_hierarchy = get_component_hierarchy()
+            new_row = get_node_feature(node, component_hierarchy, details)
+            new_row['group'] = row['group']
+            rows[i] = new_row
+            updates.append([i, new_row])
+        else:
+            row['rolledBack'] = is_rolled_back
+            rolled_back.append([i, is_rolled_back])
+
+    if not rolled_back and not updates:
+        return None
+    return {'action': 'moveMarker', 'data': {'rolled-back': rolled_back,
+                                             'update': updates}}
+
+# Row values that repeat a lot. They are sent once, in tables.
+COMPACT_TABLE_KEYS = ('type', 'image', 'parent-components')
+
+def encode_compact_rows(rows, row_indexes=None):
+    '''Encodes rows for sending, as columns instead of one object per row.
+
+    Values of COMPACT_TABLE_KEYS are replaced by indexes into tables, with
+    -1 meaning no value. Groups are referred to using row indexes, also
+    with -1 for no group. edit-name is rarely set, so it is sent as
+    row index -> name.
+
+    row_indexes maps IDs to row indexes, when the rows are a part of a
+    larger timeline.'''
+    tables = { key: [] for key in COMPACT_TABLE_KEYS }
+    table_indexes = { key: {} for key in COMPACT_TABLE_KEYS }
+    columns = { key: [] for key in ('id', 'name', 'suppressed', 'rolledBack', 'group') + COMPACT_TABLE_KEYS }
+    edit_names = {}
+    if row_indexes is None:
+        row_indexes = { row['id']: i for i, row in enumerate(rows) }
+
+    for i, row in enumerate(rows):
+        columns['id'].append(row['id'])
+        columns['name'].append(row['name'])
+        columns['suppressed'].append(1 if row['suppressed'] else 0)
+        columns['rolledBack'].append(1 if row['rolledBack'] else 0)
+        group = row['group']
+        columns['group'].append(-1 if group is None else row_indexes[group])
+        if 'edit-name' in row:
+            edit_names[i] = row['edit-name']
+
+        for key in COMPACT_TABLE_KEYS:
+            value = row.get(key)
+            if value is None:
+                columns[key].append(-1)
+                continue
+            hashable_value = tuple(value) if isinstance(value, list) else value
+            index = table_indexes[key].get(hashable_value)
+            if index is None:
+                index = len(tables[key])
+                table_indexes[key][hashable_value] = index
+                tables[key].append(value)
+            columns[key].append(index)
+
+    return {
+        'tables': tables,
+        'columns': columns,
+        'edit-names': edit_names,
+    }
+
+def flatten_features(features, group_id=None, rows=None):
+    '''Returns the feature tree as a list of rows, in display order.
+    Each row refers to its group using the 'group' key.'''
+    if rows is None:
+        rows = []
+    for feature in features:
+        row = { key: value for key, value in feature.items() if key != 'children' }
+        row['group'] = group_id
+        rows.append(row)
+        if 'children' in feature:
+            flatten_features(feature['children'], feature['id'], rows)
+    return rows
+
+def unflatten_rows(rows):
+    '''Returns the rows as a feature tree. The reverse of flatten_features().'''
+    features = []
+    groups = {}
+    for row in rows:
+        feature = { key: value for key, value in row.items() if key != 'group' }
+        if feature.get('type') == 'GROUP':
+            feature['children'] = []
+            groups[feature['id']] = feature
+        if row['group'] is None:
+            features.append(feature)
+        else:
+            groups[row['group']]['children'].append(feature)
+    return features
+
+# Row keys that are allowed to differ for a row to be considered unchanged,
+# when the row has only moved.
+ROW_POSITION_KEYS = ('id', 'group')
+
+# Row keys that are only set with the details. See get_node_details().
+ROW_DETAIL_KEYS = ('type', 'image', 'parent-components', 'edit-name')
+
+def rows_equal(old_row, new_row, ignored_keys=()):
+    '''Compares two rows, except for ignored_keys.
+
+    A row without details, e.g. inside a group that is collapsed in the
+    palette, is compared to a row with details using only the cheap fields.
+    The palette keeps the details it has and fetches the ones it lacks, so
+    collapsing or expanding a group does not change any rows.'''
+    if ('type' in old_row) != ('type' in new_row):
+        ignored_keys = ignored_keys + ROW_DETAIL_KEYS + ('name',)
+        # The details strip the name of occurrences
+        if old_row['name'].lstrip() != new_row['name'].lstrip():
+            return False
+    elif not ignored_keys:
+        return old_row == new_row
+    old_keys = [key for key in old_row if key not in ignored_keys]
+    new_keys = [key for key in new_row if key not in ignored_keys]
+    if sorted(old_keys) != sorted(new_keys):
+        return False
+    return all(old_row[key] == new_row[key] for key in old_keys)
+
+def rows_match(old_row, new_row):
+    '''Tells if a row is unchanged, if it has only moved.'''
+    return rows_equal(old_row, new_row, ROW_POSITION_KEYS)
+
+def diff_snapshot_rows(old_rows, new_rows):
+    '''Calculates the changes needed to turn old_rows into new_rows.
+
+    The rows are split into an unchanged head, a changed middle and an
+    unchanged tail. The middle is either updated row by row, if its structure
+    is intact, or replaced. When replaced, rows that have only moved are sent
+    as {'id', 'group', 'keep'}, for the palette to reuse its rows. Tail rows
+    can have gotten new IDs, if the IDs could not be kept. See
+    assign_node_ids().
+
+    Returns None if the patch would not be smaller than new_rows.'''
+    old_count = len(old_rows)
+    new_count = len(new_rows)
+    common_count = min(old_count, new_count)
+
+    head = 0
+    while head < common_count and (old_rows[head] == new_rows[head] or
+                                   rows_equal(old_rows[head], new_rows[head])):
+        head += 1
+
+    old_index_map = { row['id']: i for i, row in enumerate(old_rows) }
+    new_index_map = { row['id']: i for i, row in enumerate(new_rows) }
+
+    def parent_index(index_map, row):
+        group = row['group']
+        if group is None:
+            return -1
+        return index_map[group]
+
+    def parent_position(index_map, row, count):
+        # Parents in the tail are identified by their distance to the end,
+        # as that is what stays the same when rows are inserted or removed.
+        index = parent_index(index_map, row)
+        if index < head:
+            return ('head', index)
+        return ('tail', count - index)
+
+    tail = 0
+    while tail < common_count - head:
+        old_row = old_rows[old_count - 1 - tail]
+        new_row = new_rows[new_count - 1 - tail]
+        if (not rows_match(old_row, new_row) or
+            (parent_position(old_index_map, old_row, old_count) !=
+             parent_position(new_index_map, new_row, new_count))):
+            break
+        tail += 1
+
+    # A tail row cannot be kept if its group is in the changed middle part,
+    # as the group will be thrown away. Parents come before their children,
+    # so cutting the tail in one forward pass catches nested groups too.
+    tail_start = new_count - tail
+    for i in range(new_count - tail, new_count):
+        row = new_rows[i]
+        old_row = old_rows[i - new_count + old_count]
+        if (head <= parent_index(new_index_map, row) < tail_start or
+            head <= parent_index(old_index_map, old_row) < tail_start - new_count + old_count):
+            tail_start = i + 1
+    tail = new_count - tail_start
+
+    old_middle = old_rows[head:old_count - tail]
+    new_middle = new_rows[head:new_count - tail]
+
+    patch = {
+        'start': head,
+        'remove-count': 0,
+        'insert': [],
+        'update': [],
+    }
+    if (len(old_middle) == len(new_middle) and
+        all(old_row['id'] == new_row['id'] and
+            old_row['group'] == new_row['group'] and
+            (old_row.get('type') == 'GROUP') == (new_row.get('type') == 'GROUP')
+            for old_row, new_row in zip(old_middle, new_middle))):
+        # Same structure. Only update the rows that changed (names, suppression, ...)
+        patch['update'] = [[head + i, new_row]
+                           for i, (old_row, new_row) in enumerate(zip(old_middle, new_middle))
+                           if not rows_equal(old_row, new_row)]
+        delta_size = len(patch['update'])
+    else:
+        patch['remove-count'] = len(old_middle)
+        old_middle_rows = { row['id']: row for row in old_middle }
+        delta_size = 0
+        for new_row in new_middle:
+            old_row = old_middle_rows.get(new_row['id'])
+            if old_row is not None and rows_match(old_row, new_row):
+                patch['insert'].append({ 'id': new_row['id'], 'group': new_row['group'], 'keep': True })
+            else:
+                patch['insert'].append(new_row)
+                delta_size += 1
+
+    if tail and any(old_rows[old_count - tail + i]['id'] != new_rows[new_count - tail + i]['id']
+                    for i in range(tail)):
+        patch['tail-ids'] = [row['id'] for row in new_rows[new_count - tail:]]
+
+    if new_rows and delta_size >= len(new_rows):
+        return None
+
+    return patch
+
+def patch_is_empty(patch):
+    return (not patch['remove-count'] and not patch['insert'] and
+            not patch['update'] and 'tail-ids' not in patch)
 
 class TimelineObjectNode:
     def __init__(self, obj, id):
         self.obj = obj
         self.id = id
         self.children = []
+        # (name, is_suppressed) as last sent to the palette. See timeline_changed().
+        self.state = None
+        # Key of the parent group when the tree was built. See timeline_changed().
+        self.parent_key = None
+        # (component hierarchy, selection). See get_selection().
+        self.selection = None
+        # Inside a group that is collapsed in the palette. See mark_hidden_nodes().
+        self.hidden = False
+        # TimelineObjectInfo read when the IDs were assigned, for the first
+        # get_node_feature() of the same walk. See assign_node_ids().
+        self.info = None
 
 timeline_cache_tree = None
 timeline_cache_map = None
-def get_features(timeline):
+def get_features(timeline, details=True):
     global timeline_cache_tree, timeline_cache_map
     flat_timeline = thomasa88lib.timeline.flatten_timeline(timeline)
-    timeline_cache_tree, timeline_cache_map = build_timeline_tree(flat_timeline)
+    refresh_profiler.mark('flatten')
+    reference_rows = timeline_snapshot.rows if timeline_snapshot else None
+    timeline_cache_tree, timeline_cache_map = build_timeline_tree(flat_timeline, reference_rows)
+    mark_hidden_nodes(timeline_cache_tree)
+    refresh_profiler.mark('tree')
 
-    component_parent_map = get_component_parent_map()
+    component_hierarchy = get_component_hierarchy() if details else None
+    refresh_profiler.mark('hierarchy')
 
-    return get_features_from_node(timeline_cache_tree, component_parent_map)
+    features_and_max_parents = get_features_from_node(timeline_cache_tree, component_hierarchy, details)
+    refresh_profiler.mark('features')
+    return features_and_max_parents
 
-def get_features_from_node(timeline_tree_node, component_parent_map):
+def get_features_from_node(timeline_tree_node, component_hierarchy, details=True):
     features = []
     max_parents = 0
     for i, child_node in enumerate(timeline_tree_node.children):
-        obj = child_node.obj
-
-        feature = {
-            'id': str(child_node.id),
-            'name': obj.name,
-            'suppressed': obj.isSuppressed,
-            'rolledBack': obj.isRolledBack,
-            }
+        feature = get_node_feature(child_node, component_hierarchy, details)
 
         # Might there be empty groups?
         if child_node.children:
             # Group
-            feature['type'] = 'GROUP'
-            feature['image'] = get_image_path('Fusion/UI/FusionUI/Resources/Timeline/GroupFeature')
             feature['children'], group_max_parents = get_features_from_node(child_node,
-                                                                            component_parent_map)
+                                                                            component_hierarchy,
+                                                                            details)
             if group_max_parents > max_parents:
                 max_parents = group_max_parents
-        else:
-            # Not group
-            try:
-                entity = obj.entity
-            except RuntimeError as e:
-                entity = None
-            
-            if entity:
-                feature['type'] = thomasa88lib.utils.short_class(obj.entity)
-                feature['image'] = get_feature_image(obj)
-                parents = get_feature_parent_path(component_parent_map,
-                                                  obj)
-                feature['parent-components'] = parents
-                if len(parents) > max_parents:
-                    max_parents = len(parents)
-            else:
-                # Move and Align and more does not allow us to access their entity attribute
-                # Bug: https://forums.autodesk.com/t5/fusion-360-api-and-scripts/api-bug-cannot-access-entity-of-quot-move-quot-feature/m-p/9651921
-
-                if obj.name.startswith('Derived from '):
-                    feature['type'] = 'InsertDerive'
-                    feature['image'] = get_image_path('Fusion/UI/FusionUI/Resources/Derive/CloneWM')
-                else:
-                    feature['type'] = '? (Feature info access prohibited by Fusion 360)'
-                    feature['image'] = get_image_path('Fusion/UI/FusionUI/Resources/TSpline/Error')
-
-            if feature['type'] == 'Occurrence':
-                # Fusion uses a space separator for the timeline object name, but sometimes the first part is empty.
-                # Strip the whitespace to make the list cleaner.
-                feature['name'] = feature['name'].lstrip()
-                if thomasa88lib.timeline.get_occurrence_type(obj) != OCCURRENCE_BODIES_COMP:
-                    # Name is a read-only instance variant of the component's name,
-                    # with a prefix on it.
-                    # Let the user modify the component's name instead
-                    feature['edit-name'] = obj.entity.component.name
+        elif len(feature.get('parent-components', [])) > max_parents:
+            max_parents = len(feature['parent-components'])
 
         features.append(feature)
 
     return (features, max_parents)
 
-def get_feature_parent_path(component_parent_map, obj):
-    design = app.activeProduct
-
-    feature = obj.entity
-    feature_type = thomasa88lib.utils.short_class(feature)
+def get_node_feature(node, component_hierarchy, details=True):
+    '''Returns the feature info for a node, excluding any group children.
+
+    Without details, only the fields that are cheap to get are included.
+    The same goes for hidden nodes. The palette fetches the rest using
+    get_node_details().'''
+    info = node.info or TimelineObjectInfo(node.obj)
+    node.info = None
+    node.state = (info.name, info.is_suppressed)
+
+    feature = {
+        'id': str(node.id),
+        'name': info.name,
+        'suppressed': info.is_suppressed,
+        'rolledBack': info.is_rolled_back,
+        }
+
+    if node.children:
+        # Group
+        feature['type'] = 'GROUP'
+        feature['image'] = get_image_key(GROUP_IMAGE)
+    elif details and not node.hidden:
+        feature.update(get_node_details(info, component_hierarchy))
+
+    return feature
+
+def mark_hidden_nodes(top_node):
+    '''Marks the nodes inside the groups that are collapsed in the palette.
+    The palette fetches their details when a group is expanded.'''
+    if not palette_collapsed_groups:
+        return
+    stack = [(child, False) for child in top_node.children]
+    while stack:
+        node, hidden = stack.pop()
+        node.hidden = hidden
+        if node.children:
+            hide_children = hidden or node.obj.name in palette_collapsed_groups
+            stack.extend((child, hide_children) for child in node.children)
+
+def get_node_details(info, component_hierarchy):
+    '''Returns the feature info that requires accessing the entity of the
+    timeline object. The name is included, if it needs to be changed.'''
+    feature = {}
+
+    if info.entity:
+        feature['type'] = info.entity_type
+        feature['image'] = get_feature_image(info)
+        parents = get_feature_parent_path(component_hierarchy,
+                                          info)
+        feature['parent-components'] = parents
+    else:
+        # Entity not accessible. See TimelineObjectInfo.entity.
+        if info.name.startswith('Derived from '):
+            feature['type'] = 'InsertDerive'
+            feature['image'] = get_image_key(INSERT_DERIVE_IMAGE)
+        else:
+            feature['type'] = '? (Feature info access prohibited by Fusion 360)'
+            feature['image'] = get_image_key(ACCESS_ERROR_IMAGE)
+
+    if feature['type'] == 'Occurrence':
+        # Fusion uses a space separator for the timeline object name, but sometimes the first part is empty.
+        # Strip the whitespace to make the list cleaner.
+        feature['name'] = info.name.lstrip()
+        if info.occurrence_type != OCCURRENCE_BODIES_COMP:
+            # Name is a read-only instance variant of the component's name,
+            # with a prefix on it.
+            # Let the user modify the component's name instead
+            feature['edit-name'] = info.component.name
+
+    return feature
+
+def use_lazy_details(timeline):
+    threshold = settings['lazy_details_threshold']
+    return threshold >= 0 and timeline.count > threshold
+
+# Feature ID -> details, for details that have been sent to the palette.
+# Cleared when the IDs change.
+feature_details_cache = {}
+
+def get_feature_details(feature_ids):
+    component_hierarchy = get_component_hierarchy()
+    all_details = {}
+    for feature_id in feature_ids:
+        details = feature_details_cache.get(feature_id)
+        if details is None:
+            node = timeline_cache_map.get(int(feature_id)) if timeline_cache_map else None
+            if not node or node.children:
+                # Gone or a group. Groups always have their details.
+                continue
+            details = get_node_details(TimelineObjectInfo(node.obj), component_hierarchy)
+            feature_details_cache[feature_id] = details
+        all_details[feature_id] = details
+    return all_details
+
+def get_tree_rows(top_node):
+    '''Returns the nodes of the tree in display order, together with the
+    row index of the group of each node (-1 for no group).'''
+    nodes = []
+    group_indexes = []
+    stack = [(child, -1) for child in reversed(top_node.children)]
+    while stack:
+        node, group_index = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        group_indexes.append(group_index)
+        stack.extend((child, index) for child in reversed(node.children))
+    return nodes, group_indexes
+
+def get_feature_parent_path(component_hierarchy, info):
+    feature = info.entity
+    feature_type = info.entity_type
     if feature_type == 'Occurrence':
-        if obj.isRolledBack or obj.isSuppressed:
+        if info.is_rolled_back or info.is_suppressed:
             # No parent component will be available
             return []
-        parent_name = component_parent_map[feature.component.name]
+        return component_hierarchy.get_parent_path(info.component)
     elif feature_type == 'ConstructionPlane':
-        if (feature.parent.classType() == 'adsk::fusion::Component' and
-            feature.parent != design.rootComponent):
-            parent_name = feature.parent.name
+        parent = feature.parent
+        if parent.classType() == 'adsk::fusion::Component':
+            return component_hierarchy.get_path(parent)
         else:
             return []
-    elif not hasattr(feature, 'parentComponent'):
+
+    try:
+        parent_component = feature.parentComponent
+    except AttributeError:
         if feature_type not in [ 'Snapshot' ]:
             print("Vertical Timeline: Unhandled missing parent for " + feature.classType())
         return []
-    elif feature.parentComponent == design.rootComponent:
-        return []
-    else:
-        parent_name = feature.parentComponent.name
-
-    path = []
-    while parent_name:
-        path.append(parent_name)
-        # If the parent component was suppressed or rolled back,
-        # we won't find it, so stop in that case (get() will return None).
-        parent_name = component_parent_map.get(parent_name)
-    
-    path.reverse()
-    return path
-    
-    
+    return component_hierarchy.get_path(parent_component)
 
-def build_timeline_tree(flat_timeline):
+def build_timeline_tree(flat_timeline, reference_rows=None):
+    '''Returns the timeline as a tree of nodes and a map from node ID to
+    node. The IDs are taken from the matching rows in reference_rows, if
+    given. See assign_node_ids().'''
     # The timeline tree returned from Fusion depends on the view state of
     # the GUI timeline control. Objects are grouped/nested only if a group
     # is collapsed in the GUI. Flatten the timeline to always get the same
     # result.
 
-    next_id = 0
-    def next_node_id():
-        nonlocal next_id
-        node_id = next_id
-        next_id += 1
-        return node_id
-
     def new_node(obj):
-        node_id = next_node_id()
-        node = TimelineObjectNode(obj, node_id)
-        id_map[node_id] = node
-        return node
+        # The ID is assigned when the whole tree is known
+        return TimelineObjectNode(obj, None)
 
-    id_map = {}
-    top_node = new_node(None)
+    top_node = TimelineObjectNode(None, 0)
     in_node = top_node
-    group_nodes = [top_node]
-
-    def get_group_node(group_obj):
-        for group_node in group_nodes:
-            if group_node.obj == group_obj:
-                return group_node
-        group_node = new_node(group_obj)
-        group_nodes.append(group_node)
-        parent_node = get_group_node(group_obj.parentGroup)
-        parent_node.children.append(group_node)
+    in_group_key = None
+    # Comparing adsk objects is expensive, so the groups are indexed by key
+    group_nodes = { None: top_node }
+
+    def get_group_node(group_obj, group_key):
+        group_node = group_nodes.get(group_key)
+        if group_node:
+            return group_node
+
+        # Collect the groups that are missing, from the inside out
+        missing = []
+        while group_obj and group_key not in group_nodes:
+            missing.append((group_obj, group_key))
+            group_obj = group_obj.parentGroup
+            group_key = get_group_key(group_obj)
+
+        parent_node = group_nodes[group_key]
+        parent_key = group_key
+        for group_obj, group_key in reversed(missing):
+            group_node = new_node(group_obj)
+            group_node.parent_key = parent_key
+            parent_key = group_key
+            group_nodes[group_key] = group_node
+            parent_node.children.append(group_node)
+            parent_node = group_node
         return group_node
     
     for obj in flat_timeline:
         node = new_node(obj)
         parent_obj = obj.parentGroup
-        if parent_obj != in_node.obj:
-            in_node = get_group_node(parent_obj)
+        parent_key = get_group_key(parent_obj)
+        node.parent_key = parent_key
+        if parent_key != in_group_key:
+            in_node = get_group_node(parent_obj, parent_key)
+            in_group_key = parent_key
         in_node.children.append(node)
 
+    nodes, _ = get_tree_rows(top_node)
+    assign_node_ids(nodes, reference_rows)
+    id_map = { node.id: node for node in nodes }
+    id_map[top_node.id] = top_node
     return top_node, id_map
 
-def get_component_parent_map():
-    design = app.activeProduct
-    component_parent_map = {}
-    parent_map_occurrence(component_parent_map,
-     None,
-     design.rootComponent.occurrences)
+def assign_node_ids(nodes, reference_rows):
+    '''Gives the nodes, in display order, the IDs of the matching rows in
+    reference_rows, so that an object keeps its ID when objects are
+    inserted, removed or moved before it. Without reference rows, the
+    nodes are numbered from 1.
+
+    Rows are matched by name, in order. A node without a match takes the
+    unmatched row after the row of the node before it, which covers renamed
+    objects. The other nodes get IDs that are not in reference_rows.'''
+    if not reference_rows:
+        for node_id, node in enumerate(nodes, 1):
+            node.id = node_id
+        return
 
-    return component_parent_map
+    # (name, is group) -> indexes of the rows with it, last first
+    row_indexes = {}
+    for i in reversed(range(len(reference_rows))):
+        row = reference_rows[i]
+        key = (row['name'].lstrip(), row.get('type') == 'GROUP')
+        row_indexes.setdefault(key, []).append(i)
+
+    # Index of the matching row, for each node
+    matches = [None] * len(nodes)
+    for n, node in enumerate(nodes):
+        # The name is needed for the row anyway
+        node.info = TimelineObjectInfo(node.obj)
+        indexes = row_indexes.get((node.info.name.lstrip(), bool(node.children)))
+        if indexes:
+            matches[n] = indexes.pop()
+
+    matched_rows = set(matches)
+    previous = -1
+    for n, node in enumerate(nodes):
+        candidate = previous + 1
+        if (matches[n] is None and candidate < len(reference_rows) and
+            candidate not in matched_rows and
+            (reference_rows[candidate].get('type') == 'GROUP') == bool(node.children)):
+            matches[n] = candidate
+            matched_rows.add(candidate)
+        if matches[n] is not None:
+            previous = matches[n]
+
+    next_id = max(int(row['id']) for row in reference_rows) + 1
+    for node, match in zip(nodes, matches):
+        if match is None:
+            node.id = next_id
+            next_id += 1
+        else:
+            node.id = int(reference_rows[match]['id'])
 
-def parent_map_occurrence(component_parent_map, parent_name, occurrences):
-    for occurrence in occurrences:
-        name = occurrence.component.name
-        component_parent_map[name] = parent_name
-        parent_map_occurrence(component_parent_map,
-         name,
-         occurrence.childOccurrences)
+def get_group_key(group_obj):
+    '''Returns a key that identifies a group within one timeline walk.'''
+    if not group_obj:
+        return None
+    return group_obj.index
+
+class ComponentHierarchy:
+    '''Parent component paths, for the components in a design.
+
+    Components are identified by their persistent IDs, so that components
+    with the same name are kept apart. Entity tokens cannot be used, as the
+    token of an entity can differ between reads.'''
+    def __init__(self, design, fingerprint):
+        self.fingerprint = fingerprint
+        self.root_component = design.rootComponent
+        self.root_key = get_component_key(self.root_component)
+        # Component key -> (component name, parent component key)
+        self.parents = {}
+        # Component key -> list of component names, root first
+        self.paths = {}
+        # Component key -> list of all occurrences of the component, filled in
+        # when asked for
+        self.occurrences = {}
+
+        # All occurrences of a component have the same children, so each
+        # component only needs to be walked once.
+        stack = [(occurrence, None) for occurrence in self.root_component.occurrences]
+        stack.reverse()
+        while stack:
+            occurrence, parent_key = stack.pop()
+            component = occurrence.component
+            key = get_component_key(component)
+            if key in self.parents:
+                continue
+            self.parents[key] = (component.name, parent_key)
+            children = [(child, key) for child in occurrence.childOccurrences]
+            children.reverse()
+            stack.extend(children)
+
+    def get_path(self, component):
+        '''Returns the names of the component and its parents, root first.
+        The root component is not included.'''
+        key = get_component_key(component)
+        if key == self.root_key:
+            return []
+        path = self.paths.get(key)
+        if path is None:
+            if key in self.parents:
+                path = self._get_key_path(key)
+            else:
+                # The component is not reachable from the root. Its parents
+                # are probably suppressed or rolled back.
+                path = [component.name]
+                self.paths[key] = path
+        return path
+
+    def get_parent_path(self, component):
+        '''Returns the names of the parents of the component, root first.'''
+        entry = self.parents.get(get_component_key(component))
+        if not entry or entry[1] is None:
+            return []
+        return self._get_key_path(entry[1])
+
+    def get_occurrences(self, component):
+        '''Returns all occurrences of the component, including nested ones.'''
+        key = get_component_key(component)
+        occurrences = self.occurrences.get(key)
+        if occurrences is None:
+            occurrences = list(self.root_component.allOccurrencesByComponent(component))
+            self.occurrences[key] = occurrences
+        return occurrences
+
+    def _get_key_path(self, key):
+        # Walk up until a component with a known path is found
+        chain = []
+        path = None
+        while key is not None:
+            path = self.paths.get(key)
+            if path is not None:
+                break
+            chain.append(key)
+            key = self.parents[key][1]
+
+        path = path or []
+        for key in reversed(chain):
+            path = path + [self.parents[key][0]]
+            self.paths[key] = path
+        return path
+
+def get_selection(node):
+    '''Returns an ObjectCollection with the entity of the timeline object,
+    or its proxies in all occurrences of its component.
+
+    Creating the proxies is slow in assemblies with many occurrences, so
+    the collection is kept on the node until the component hierarchy
+    changes.'''
+    component_hierarchy = get_component_hierarchy()
+    if node.selection and node.selection[0] is component_hierarchy:
+        return node.selection[1]
+
+    entity = node.obj.entity
+    selection = adsk.core.ObjectCollection.create()
+
+    if isinstance(entity, adsk.fusion.Occurrence):
+        associated_component = entity.sourceComponent
+    elif isinstance(entity, adsk.fusion.ConstructionPlane):
+        associated_component = entity.parent
+    else:
+        associated_component = entity.parentComponent
+
+    if associated_component == component_hierarchy.root_component:
+        # There are no occurrences of root. Just a single instance: root. Can select the entity directly.
+        selection.add(entity)
+    else:
+        #Using _all_OccurrencesByComponent to get nested occurrences.
+        in_occurrences = component_hierarchy.get_occurrences(associated_component)
+        if hasattr(entity, 'createForAssemblyContext'):
+            for occurrence in in_occurrences:
+                proxy = entity.createForAssemblyContext(occurrence)
+                selection.add(proxy)
+        elif hasattr(entity, 'bodies'):
+            # Workaround for Feature objects
+            ### TODO: Correctly select Feature objects. E.g. BoxFeature, CylinderFeature, ...
+            ###       so that editing them works.
+            for body in entity.bodies:
+                for occurrence in in_occurrences:
+                    proxy = body.createForAssemblyContext(occurrence)
+                    selection.add(proxy)
+
+    node.selection = (component_hierarchy, selection)
+    return selection
+
+def get_combined_selection(nodes):
+    '''Returns one ObjectCollection with the selections of all nodes.
+    Groups and objects without an accessible entity are skipped.'''
+    selection = adsk.core.ObjectCollection.create()
+    for node in nodes:
+        if node.children:
+            # Group
+            continue
+        try:
+            node_selection = get_selection(node)
+        except RuntimeError:
+            # Entity not accessible. See TimelineObjectInfo.entity.
+            continue
+        for i in range(node_selection.count):
+            selection.add(node_selection.item(i))
+    return selection
+
+def get_renamed_component(obj):
+    '''Returns the component to rename in place of the timeline object, or
+    None. The name of an occurrence is a read-only instance variant of the
+    name of its component.'''
+    if obj.isGroup:
+        return None
+    try:
+        entity = obj.entity
+    except RuntimeError:
+        # Move and Align does not allow us to access their entity attribute
+        return None
+    if (entity
+        and entity.classType() == 'adsk::fusion::Occurrence'
+        and thomasa88lib.timeline.get_occurrence_type(obj) != OCCURRENCE_BODIES_COMP):
+        return entity.component
+    return None
+
+def set_feature_name(obj, name):
+    '''Renames the timeline object, or its component. Returns the name
+    shown in the timeline.'''
+    component = get_renamed_component(obj)
+    if component:
+        # Bonus of not doing a Command transaction: Undo history actually says from and to name.
+        component.name = name
+        # The component paths contain the old name
+        invalidate_component_hierarchy()
+    else:
+        obj.name = name
+    return obj.name.lstrip()
+
+def rename_features(nodes, pattern):
+    '''Renames the nodes using a pattern, where {name} is replaced by the
+    current name and {n} by the position of the node in nodes, from 1.
+    Returns the number of renamed nodes.'''
+    renamed = 0
+    for n, node in enumerate(nodes, 1):
+        obj = node.obj
+        component = get_renamed_component(obj)
+        old_name = component.name if component else obj.name
+        name = pattern.replace('{name}', old_name).replace('{n}', str(n))
+        if name and name != old_name:
+            set_feature_name(obj, name)
+            renamed += 1
+    return renamed
+
+def set_features_suppressed(nodes, suppressed):
+    '''Suppresses or unsuppresses the nodes. Returns the names of the
+    timeline objects that Fusion refused to change.'''
+    failed = []
+    for node in nodes:
+        obj = node.obj
+        if obj.isSuppressed == suppressed:
+            continue
+        try:
+            obj.isSuppressed = suppressed
+        except RuntimeError:
+            failed.append(obj.name.lstrip())
+    return failed
+
+def get_component_key(component):
+    return component.id
+
+# Substrings of command IDs that can change the component structure without
+# changing the number of components or occurrences. E.g. renames and moves.
+COMPONENT_STRUCTURE_COMMAND_HINTS = ('component', 'occurrence', 'rename', 'paste', 'undo', 'redo')
+
+component_hierarchy = None
+# The fingerprint of component_hierarchy has been checked since the last
+# command or refresh. Reading allOccurrences is slow in large assemblies, so
+# it is not done for every lookup.
+component_hierarchy_checked = False
+
+def get_component_hierarchy():
+    global component_hierarchy, component_hierarchy_checked
+    if component_hierarchy and component_hierarchy_checked:
+        return component_hierarchy
+    design = app.activeProduct
+    root_component = design.rootComponent
+    fingerprint = (design,
+                   design.allComponents.count,
+                   root_component.allOccurrences.count)
+    if not component_hierarchy or component_hierarchy.fingerprint != fingerprint:
+        component_hierarchy = ComponentHierarchy(design, fingerprint)
+        refresh_profiler.count('components', len(component_hierarchy.parents))
+    component_hierarchy_checked = True
+    return component_hierarchy
+
+def recheck_component_hierarchy():
+    '''Makes the next get_component_hierarchy() check the fingerprint.'''
+    global component_hierarchy_checked
+    component_hierarchy_checked = False
+
+def invalidate_component_hierarchy():
+    global component_hierarchy
+    component_hierarchy = None
+    # The details contain component paths
+    feature_details_cache.clear()
+
+def is_component_structure_command(command_id):
+    command_id = command_id.lower()
+    return any(hint in command_id for hint in COMPONENT_STRUCTURE_COMMAND_HINTS)
 
 def get_view_drop_down():
     qat = ui.toolbars.itemById('QAT')
@@ -449,22 +1501,50 @@ def get_view_drop_down():
     view_drop_down = file_drop_down.controls.itemById('ViewWidgetCommand')
     return view_drop_down
 
-def check_timeline():
-    global timeline_item_count
-    global timeline_marker_position
-    global html_ready
+def timeline_changed(check_objects=True):
+    '''Checks if the timeline differs from what was last sent to the palette,
+    using the item count, the marker position and, if check_objects is True,
+    the names, suppression states and positions of the timeline objects.
+    The nodes are in timeline order, so a reordered object shows as an
+    index that is out of order. Objects moved in or out of groups show as
+    changed parent groups.
+
+    This is a lot cheaper than a refresh, as the entities are not accessed.'''
+    if timeline_snapshot is None or not timeline_cache_map:
+        # Nothing sent, or still streaming
+        return True
     timeline_status, timeline = thomasa88lib.timeline.get_timeline()
-    if timeline_status == TIMELINE_STATUS_OK:
-        if (timeline.count != timeline_item_count or
-            timeline.markerPosition != timeline_marker_position):
-            invalidate()
-    else:
-        timeline_item_count = -1
-        timeline_marker_position = -1
+    if timeline_status != TIMELINE_STATUS_OK:
+        return True
+    if (timeline.count != timeline_item_count or
+        timeline.markerPosition != timeline_marker_position):
+        return True
+    if not check_objects:
+        return False
+    try:
+        previous_index = -1
+        for node in timeline_cache_map.values():
+            obj = node.obj
+            if not obj:
+                continue
+            if (obj.name, obj.isSuppressed) != node.state:
+                return True
+            if get_group_key(obj.parentGroup) != node.parent_key:
+                return True
+            if not node.children:
+                index = obj.index
+                if index <= previous_index:
+                    return True
+                previous_index = index
+    except RuntimeError:
+        # The object has been deleted
+        return True
+    return False
 
 def run(context):
     global ui, app
     debug = False
+    run_start_time = time.perf_counter()
     with error_catcher:
         app = adsk.core.Application.get()
         ui = app.userInterface
@@ -518,17 +1598,22 @@ def run(context):
                     adsk.core.WorkspaceEventHandler,
                     workspace_activated_handler)
 
-        print("Running")
-
         # Show palette when user starts the add-in manually
         if get_enabled() and app.isStartupComplete:
             show_palette()
 
+        startup_timing['run-ms'] = round((time.perf_counter() - run_start_time) * 1000, 3)
+        print(f"Running (loaded in {startup_timing['import-ms']} ms, run in {startup_timing['run-ms']} ms)")
+
 def stop(context):
     with error_catcher:
         print('Stopping')
 
         events_manager.clean_up()
+        refresh_scheduler.stop()
+        timeline_stream.stop()
+        selection_prewarmer.stop()
+        document_cache.save_current()
 
         # Delete the palette created by this add-in.
         palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
@@ -562,8 +1647,9 @@ def show_palette():
     palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
     if not palette:
         html_ready = False
+        start_palette_services()
 
-        palette = ui.palettes.add('thomasa88_verticalTimelinePalette', f'Vertical Timeline v{manifest["version"]}',
+        palette = ui.palettes.add('thomasa88_verticalTimelinePalette', f'Vertical Timeline v{get_manifest()["version"]}',
                                     'palette.html',
                                     True, True, True, 250, 500, False)
         palette.dockingState = adsk.core.PaletteDockingStates.PaletteDockStateLeft
@@ -576,10 +1662,21 @@ def show_palette():
                                    adsk.core.UserInterfaceGeneralEventHandler,
                                    palette_closed_handler)        
     else:
-        invalidate()
+        document_cache.show_active_document()
         if not palette.isVisible:
             palette.isVisible = True
 
+def start_palette_services():
+    '''Registers the custom events that the palette needs. Done when the
+    palette is first created, to not slow down the Fusion startup for users
+    that do not use the palette.'''
+    if refresh_scheduler.event:
+        # Already started
+        return
+    refresh_scheduler.start()
+    timeline_stream.start()
+    selection_prewarmer.start()
+
 def hide_palette():
     palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
     if palette:
@@ -599,92 +1696,113 @@ def palette_closed_handler(args):
 # Event handler for the palette HTML event.                
 def palette_incoming_from_html_handler(args):
     global html_ready
+    global timeline_snapshot
+    global palette_collapsed_groups
     htmlArgs = adsk.core.HTMLEventArgs.cast(args)
     action = htmlArgs.action
     data = json.loads(htmlArgs.data)
     html_commands = []
-    if action == 'ready':
-        print('HTML ready')
-        html_ready = True
-
-        # Cannot do sendInfoToHTML inside the event handler. We either have to use htmlArgs.returnData or
-        # spawn a thread (does not seem very safe? Can we call into the event loop instead?).
-        html_commands.append(invalidate(send=False))
+    if action == 'ready' or action == 'resync':
+        if action == 'ready':
+            print('HTML ready')
+            html_ready = True
+            palette_collapsed_groups = set(data.get('collapsed-groups', []))
+        else:
+            print('HTML out of sync. Sending the full timeline.')
+
+        # The palette has nothing (or something broken) to patch
+        timeline_snapshot = None
+        document_cache.set_current(get_active_document_key())
+
+        stale_command = None
+        if action == 'ready':
+            stale_command = document_cache.show_from_disk()
+        if stale_command:
+            # Show the stored timeline now and check it from the event loop
+            html_commands.append(stale_command)
+            refresh_scheduler.request_later()
+        else:
+            # Cannot do sendInfoToHTML inside the event handler. We either have to use htmlArgs.returnData or
+            # spawn a thread (does not seem very safe? Can we call into the event loop instead?).
+            html_commands.append(invalidate(send=False))
+        icons_command = make_icons_command()
+        if icons_command:
+            html_commands.insert(0, icons_command)
+        if settings['profiling']:
+            html_commands.append({'action': 'setProfiling', 'data': {'enabled': True}})
     elif action == 'setFeatureName':
         node = timeline_cache_map[data['id']]
-        obj = node.obj
         visible_name = None
         if data['value'] != '':
-            try:
-                entity = obj.entity
-            except RuntimeError:
-                # Move and Align does not allow us to access their entity attribute
-                entity = None
-            if (not obj.isGroup
-                and entity
-                and entity.classType() == 'adsk::fusion::Occurrence'
-                and thomasa88lib.timeline.get_occurrence_type(obj) != OCCURRENCE_BODIES_COMP):
-                # Bonus of not doing a Command transaction: Undo history actually says from and to name.
-                entity.component.name = data['value']
-                # The shown name will have changed. Invalidate.
-                #html_commands.append(invalidate(send=False))
-            else:
-                obj.name = data['value']
-            visible_name = obj.name.lstrip()
+            visible_name = set_feature_name(node.obj, data['value'])
         html_commands.append(visible_name)
+    elif action == 'getFeatureDetails':
+        html_commands.append(get_feature_details(data['ids']))
+    elif action == 'getIcons':
+        html_commands.append(get_icons(data['keys']))
+    elif action == 'setCollapsedGroups':
+        # Takes effect on the next refresh. The palette fetches the details
+        # of the groups it expands.
+        palette_collapsed_groups = set(data['names'])
+        html_commands.append(True)
+    elif action == 'setProfiling':
+        settings['profiling'] = data['enabled']
+        html_commands.append(True)
+    elif action == 'getProfile':
+        refresh_profiler.html_history.extend(data['palette'])
+        html_commands.append(refresh_profiler.get_entries(data['since']))
+        html_commands.append(get_cache_counters())
+    elif action == 'exportProfile':
+        refresh_profiler.html_history.extend(data['palette'])
+        html_commands.append(refresh_profiler.export())
+    elif action == 'prepareSelection':
+        selection_prewarmer.request(data['ids'])
+        html_commands.append(True)
     elif action == 'selectFeature' or action == 'editFeature':
         node = timeline_cache_map[data['id']]
         obj = node.obj
         ret = True
 
-        design: adsk.fusion.Design = app.activeProduct
-        entity = obj.entity
-
-        # Making this in a transactory way so the current selection is not removed
-        # if the entity is not selectable.
-        newSelection = adsk.core.ObjectCollection.create()
-
-        if isinstance(entity, adsk.fusion.Occurrence):
-            associated_component = entity.sourceComponent
-        elif isinstance(entity, adsk.fusion.ConstructionPlane):
-            associated_component = entity.parent
-        else:
-            associated_component = entity.parentComponent
-
-        if associated_component == design.rootComponent:
-            # There are no occurrences of root. Just a single instance: root. Can select the entity directly.
-            newSelection.add(entity)
-        else:
-            #Using _all_OccurrencesByComponent to get nested occurrences.
-            in_occurrences = design.rootComponent.allOccurrencesByComponent(associated_component)
-            if hasattr(entity, 'createForAssemblyContext'):
-                for occurrence in in_occurrences:
-                    proxy = entity.createForAssemblyContext(occurrence)
-                    newSelection.add(proxy)
-            elif hasattr(entity, 'bodies'):
-                # Workaround for Feature objects
-                ### TODO: Correctly select Feature objects. E.g. BoxFeature, CylinderFeature, ...
-                ###       so that editing them works.
-                for body in entity.bodies:
-                    for occurrence in in_occurrences:
-                        proxy = body.createForAssemblyContext(occurrence)
-                        newSelection.add(proxy)
+        newSelection = get_selection(node)
 
         try:
             ui.activeSelections.all = newSelection
         except Exception as e:
-            ui.messageBox(f'Failed to select {thomasa88lib.utils.short_class(entity)}: {e}')
+            ui.messageBox(f'Failed to select {thomasa88lib.utils.short_class(obj.entity)}: {e}')
             ret = False
         
         if ret and action == 'editFeature':
-            command_id = get_feature_edit_command_id(obj)
+            command_id = get_feature_edit_command_id(TimelineObjectInfo(obj))
             if command_id:
                 #print("T", ui.terminateActiveCommand())
                 ui.commandDefinitions.itemById(command_id).execute()
             else:
-                ui.messageBox(f'Editing {thomasa88lib.utils.short_class(entity)} feature is not supported')
+                ui.messageBox(f'Editing {thomasa88lib.utils.short_class(obj.entity)} feature is not supported')
                 ret = False
         html_commands.append(ret)
+    elif action == 'selectFeatures':
+        # All features in one selection, instead of one call per feature
+        nodes = [timeline_cache_map[feature_id] for feature_id in data['ids']]
+        ret = True
+        try:
+            ui.activeSelections.all = get_combined_selection(nodes)
+        except Exception as e:
+            ui.messageBox(f'Failed to select the features: {e}')
+            ret = False
+        html_commands.append(ret)
+    elif action == 'suppressFeatures' or action == 'renameFeatures':
+        # The timeline is refreshed once, after all features have changed
+        nodes = [timeline_cache_map[feature_id] for feature_id in data['ids']]
+        if action == 'suppressFeatures':
+            failed = set_features_suppressed(nodes, data['suppressed'])
+            if failed:
+                ui.messageBox(f'Failed to change the suppression of: {", ".join(failed)}')
+            html_commands.append(len(failed) == 0)
+        else:
+            html_commands.append(rename_features(nodes, data['pattern']))
+        html_command = invalidate(send=False)
+        if html_command:
+            html_commands.append(html_command)
     elif action == 'rollToFeature':
         node = timeline_cache_map[data['id']]
         obj = node.obj
@@ -697,10 +1815,17 @@ def palette_incoming_from_html_handler(args):
             # Move to the group instead.
             obj = obj.parentGroup
         html_commands.append(obj.rollTo(False))
-        html_commands.append(invalidate(send=False))
+        html_command = invalidate(send=False, marker_only=True)
+        if html_command:
+            html_commands.append(html_command)
 
     if html_commands:
         htmlArgs.returnData = json.dumps(html_commands)
+        if refresh_profiler.current:
+            # Encoding of the invalidate(send=False) result
+            refresh_profiler.mark('json')
+            refresh_profiler.count('bytes', len(htmlArgs.returnData))
+    refresh_profiler.end()
 
 def command_terminated_handler(args):
     eventArgs = adsk.core.ApplicationCommandEventArgs.cast(args)
@@ -714,11 +1839,410 @@ def command_terminated_handler(args):
     # Helper to trace feature images
     #trace_feature_image(eventArgs)
 
+    command_id = eventArgs.commandId
+
     # Heavy traffic commands
-    if eventArgs.commandId in ['SelectCommand', 'CommitCommand']:
+    if command_id in ['SelectCommand', 'CommitCommand']:
+        return
+
+    recheck_component_hierarchy()
+    structure_changed = is_component_structure_command(command_id)
+    if structure_changed:
+        invalidate_component_hierarchy()
+
+    if not html_ready:
+        # Nothing shown to refresh
+        return
+
+    if (not structure_changed and
+        not refresh_gate.needs_refresh(command_id, learn=not refresh_scheduler.is_pending())):
         return
     
-    invalidate()
+    refresh_scheduler.request(marker_only=(command_id in MARKER_COMMAND_IDS))
+
+# Commands that usually only move the timeline marker
+MARKER_COMMAND_IDS = ('UndoCommand', 'RedoCommand')
+
+class RefreshScheduler:
+    '''Coalesces refresh requests that come in bursts (scripts, patterns,
+    undo/redo) into one refresh.
+
+    The refresh is done when no request has arrived for the delay time, or
+    when the oldest request has waited for the max delay time. A timer
+    thread keeps track of the time and fires a custom event to get back to
+    the main thread.'''
+
+    EVENT_ID = 'thomasa88_verticalTimelineRefresh'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timer = None
+        self.first_request_time = None
+        self.last_request_time = None
+        # If all pending requests only expect the marker to have moved
+        self.marker_only = False
+        self.event = None
+
+    def start(self):
+        self.event = register_custom_event(self.EVENT_ID, self.custom_event_handler)
+
+    def stop(self):
+        with self.lock:
+            self._cancel_timer()
+            self.first_request_time = None
+        if self.event:
+            # The handler is removed by the events manager
+            app.unregisterCustomEvent(self.EVENT_ID)
+            self.event = None
+
+    def is_pending(self):
+        with self.lock:
+            return self.first_request_time is not None
+
+    def request(self, marker_only=False):
+        delay = settings['refresh_delay_ms'] / 1000
+        if delay <= 0 or not self.event:
+            invalidate(marker_only=marker_only)
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            if self.first_request_time is None:
+                self.first_request_time = now
+                self.marker_only = marker_only
+            else:
+                self.marker_only = self.marker_only and marker_only
+            self.last_request_time = now
+            if not self.timer:
+                self._start_timer(delay)
+
+    def request_later(self):
+        '''Refreshes from the event loop, without delay. For callers that
+        cannot send to the palette, like the palette event handler.'''
+        if not self.event:
+            return
+        with self.lock:
+            self._cancel_timer()
+            self.first_request_time = time.monotonic()
+            self.last_request_time = self.first_request_time
+            self.marker_only = False
+        app.fireCustomEvent(self.EVENT_ID)
+
+    def _start_timer(self, delay):
+        self.timer = threading.Timer(delay, self._timer_expired)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _timer_expired(self):
+        # Timer thread
+        with self.lock:
+            self.timer = None
+            if self.first_request_time is None:
+                return
+            now = time.monotonic()
+            delay = settings['refresh_delay_ms'] / 1000
+            max_delay = settings['refresh_max_delay_ms'] / 1000
+            quiet_left = self.last_request_time + delay - now
+            latency_left = self.first_request_time + max_delay - now
+            wait = min(quiet_left, latency_left)
+            if wait > 0:
+                # More requests came in. Keep waiting.
+                self._start_timer(wait)
+                return
+        app.fireCustomEvent(self.EVENT_ID)
+
+    def custom_event_handler(self, args):
+        with self.lock:
+            if self.first_request_time is None:
+                # Canceled
+                return
+            self.first_request_time = None
+            marker_only = self.marker_only
+        invalidate(marker_only=marker_only)
+
+refresh_scheduler = RefreshScheduler()
+
+# Substrings of command IDs that can change the timeline rows without
+# changing the fingerprint of timeline_changed(). E.g. edits that turn a
+# solid feature into a surface feature. Reorders are also included, as
+# learned commands do not check the order.
+REFRESH_GATE_BYPASS_COMMAND_HINTS = ('edit', 'reorder', 'move')
+
+# Times in a row that a command must leave the timeline unchanged, to be
+# skipped without checking the timeline
+REFRESH_GATE_LEARN_COUNT = 3
+
+# Skips of a learned command between full checks of the timeline
+REFRESH_GATE_RECHECK_SKIPS = 20
+
+class RefreshGate:
+    '''Skips the refresh after commands that did not change the timeline,
+    such as view, visibility and measure commands.
+
+    The timeline is checked using timeline_changed(). Commands that have
+    left the timeline unchanged REFRESH_GATE_LEARN_COUNT times in a row,
+    and have never changed it, are learned. For them, only the item count
+    and the marker position are checked, except for every
+    REFRESH_GATE_RECHECK_SKIPS skips, when the whole check is done. A
+    learned command that changes the timeline is unlearned.'''
+    def __init__(self):
+        # Command ID -> times in a row that the timeline was unchanged
+        self.unchanged_counts = {}
+        # Commands that have changed the timeline at least once
+        self.changing_commands = set()
+        # Learned command ID -> skips since the last full check
+        self.skip_counts = {}
+        # hits: unchanged timelines, misses: changed timelines,
+        # skips: learned commands with the same item count and marker position
+        self.counters = { 'hits': 0, 'misses': 0, 'skips': 0 }
+
+    def needs_refresh(self, command_id, learn=True):
+        '''Returns False if the refresh after the command can be skipped.
+
+        learn should be False if a refresh is already pending, as the
+        timeline is then compared to an outdated state.'''
+        if not settings['refresh_gate']:
+            return True
+        lower_command_id = command_id.lower()
+        if any(hint in lower_command_id for hint in REFRESH_GATE_BYPASS_COMMAND_HINTS):
+            return True
+
+        if (self.unchanged_counts.get(command_id, 0) >= REFRESH_GATE_LEARN_COUNT and
+            self.skip_counts.get(command_id, 0) < REFRESH_GATE_RECHECK_SKIPS):
+            if not timeline_changed(check_objects=False):
+                self.counters['skips'] += 1
+                self.skip_counts[command_id] = self.skip_counts.get(command_id, 0) + 1
+                return False
+            self.counters['misses'] += 1
+            if learn:
+                self.changing_commands.add(command_id)
+                self.unchanged_counts.pop(command_id, None)
+                self.skip_counts.pop(command_id, None)
+            return True
+
+        refresh_profiler.begin('gate')
+        changed = timeline_changed()
+        refresh_profiler.mark('fingerprint')
+        refresh_profiler.count('changed', int(changed))
+        refresh_profiler.end()
+        self.counters['misses' if changed else 'hits'] += 1
+        self.skip_counts.pop(command_id, None)
+        if learn:
+            if changed:
+                self.changing_commands.add(command_id)
+                self.unchanged_counts.pop(command_id, None)
+            elif command_id not in self.changing_commands:
+                self.unchanged_counts[command_id] = self.unchanged_counts.get(command_id, 0) + 1
+        return changed
+
+refresh_gate = RefreshGate()
+
+class TimelineStream:
+    '''Sends a large timeline to the palette in chunks, so that the user
+    sees the first rows before the whole timeline has been walked.
+
+    The chunk around the timeline marker is sent first, together with the
+    structure of the timeline, then the chunks around it. Each chunk is
+    walked and sent in its own custom event, to let Fusion and the palette
+    work in between. The snapshot is stored when all chunks have been sent,
+    so later changes can be sent as patches.'''
+
+    EVENT_ID = 'thomasa88_verticalTimelineStream'
+
+    def __init__(self):
+        self.event = None
+        self.stream_id = 0
+        self.in_progress = False
+        self.nodes = None
+        self.rows = None
+
+    def start(self):
+        self.event = register_custom_event(self.EVENT_ID, self.custom_event_handler)
+
+    def stop(self):
+        self.cancel()
+        if self.event:
+            # The handler is removed by the events manager
+            app.unregisterCustomEvent(self.EVENT_ID)
+            self.event = None
+
+    def cancel(self):
+        self.in_progress = False
+        self.nodes = None
+        self.rows = None
+
+    def should_stream(self, timeline):
+        chunk_size = settings['stream_chunk_size']
+        return self.event is not None and chunk_size > 0 and timeline.count > chunk_size
+
+    def begin(self, timeline, details=True):
+        global timeline_cache_tree, timeline_cache_map
+        self.stream_id += 1
+        self.details = details
+        self.chunk_size = settings['stream_chunk_size']
+        flat_timeline = thomasa88lib.timeline.flatten_timeline(timeline)
+        refresh_profiler.mark('flatten')
+        timeline_cache_tree, timeline_cache_map = build_timeline_tree(flat_timeline)
+        mark_hidden_nodes(timeline_cache_tree)
+        refresh_profiler.mark('tree')
+        self.component_hierarchy = get_component_hierarchy() if details else None
+        refresh_profiler.mark('hierarchy')
+        self.nodes, group_indexes = get_tree_rows(timeline_cache_tree)
+        self.ids = [str(node.id) for node in self.nodes]
+        self.row_indexes = { node_id: i for i, node_id in enumerate(self.ids) }
+        self.group_ids = [self.ids[i] if i >= 0 else None for i in group_indexes]
+        self.rows = [None] * len(self.nodes)
+        self.max_parents = 0
+
+        marker_row = self.get_marker_row(timeline.markerPosition)
+        self.chunk_starts = self.get_chunk_order(marker_row)
+        self.chunk_starts.reverse()
+        self.in_progress = True
+
+        data = {
+            'stream': self.stream_id,
+            'message': '',
+            'ids': self.ids,
+            'groups': group_indexes,
+            'marker-row': marker_row,
+            'chunk': self.next_chunk(),
+        }
+        refresh_profiler.mark('chunk')
+        app.fireCustomEvent(self.EVENT_ID)
+        return {'action': 'beginTimeline', 'data': data}
+
+    def get_marker_row(self, marker_position):
+        # Groups are not part of the flat timeline, so count the other rows
+        # to find the marker.
+        item_index = 0
+        for row, node in enumerate(self.nodes):
+            if not node.children:
+                if item_index == marker_position:
+                    return row
+                item_index += 1
+        return max(0, len(self.nodes) - 1)
+
+    def get_chunk_order(self, first_row):
+        chunk_count = (len(self.nodes) + self.chunk_size - 1) // self.chunk_size
+        first_chunk = first_row // self.chunk_size
+        order = [first_chunk]
+        distance = 1
+        while len(order) < chunk_count:
+            if first_chunk + distance < chunk_count:
+                order.append(first_chunk + distance)
+            if first_chunk - distance >= 0:
+                order.append(first_chunk - distance)
+            distance += 1
+        return [chunk * self.chunk_size for chunk in order]
+
+    def next_chunk(self):
+        start = self.chunk_starts.pop()
+        end = min(start + self.chunk_size, len(self.nodes))
+        for i in range(start, end):
+            row = get_node_feature(self.nodes[i], self.component_hierarchy, self.details)
+            row['group'] = self.group_ids[i]
+            self.rows[i] = row
+            parent_count = len(row.get('parent-components', []))
+            if parent_count > self.max_parents:
+                self.max_parents = parent_count
+        chunk = encode_compact_rows(self.rows[start:end], self.row_indexes)
+        chunk['stream'] = self.stream_id
+        chunk['start'] = start
+        chunk['max-parents'] = self.max_parents
+        return chunk
+
+    def custom_event_handler(self, args):
+        global timeline_snapshot
+        if not self.in_progress:
+            return
+
+        palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
+        if not palette or not html_ready:
+            self.cancel()
+            return
+
+        if self.chunk_starts:
+            refresh_profiler.begin('chunk')
+            chunk = self.next_chunk()
+            refresh_profiler.mark('chunk')
+            json_data = json.dumps(chunk)
+            refresh_profiler.mark('json')
+            palette.sendInfoToHTML('timelineChunk', json_data)
+            refresh_profiler.mark('send')
+            refresh_profiler.count('bytes', len(json_data))
+            refresh_profiler.end()
+            app.fireCustomEvent(self.EVENT_ID)
+        else:
+            timeline_snapshot = TimelineSnapshot(self.rows, self.max_parents, '')
+            feature_details_cache.clear()
+            palette.sendInfoToHTML('endTimeline', json.dumps({
+                'stream': self.stream_id,
+                'max-parents': self.max_parents,
+            }))
+            self.cancel()
+
+timeline_stream = TimelineStream()
+
+class SelectionPrewarmer:
+    '''Builds the selections of the rows that the palette shows, ahead of
+    the user clicking them. See get_selection().
+
+    One row is handled per custom event, to let Fusion work in between.'''
+
+    EVENT_ID = 'thomasa88_verticalTimelinePrewarm'
+
+    def __init__(self):
+        self.event = None
+        self.pending = deque()
+
+    def start(self):
+        self.event = register_custom_event(self.EVENT_ID, self.custom_event_handler)
+
+    def stop(self):
+        self.pending.clear()
+        if self.event:
+            # The handler is removed by the events manager
+            app.unregisterCustomEvent(self.EVENT_ID)
+            self.event = None
+
+    def request(self, ids):
+        if not self.event or not settings['prewarm_selection']:
+            return
+        # Only the rows currently in view are of interest
+        idle = not self.pending
+        self.pending = deque(ids)
+        if idle and self.pending:
+            app.fireCustomEvent(self.EVENT_ID)
+
+    def custom_event_handler(self, args):
+        if not self.pending:
+            return
+        node_id = int(self.pending.popleft())
+        node = timeline_cache_map.get(node_id) if timeline_cache_map else None
+        if node and node.obj and not node.children:
+            try:
+                get_selection(node)
+            except RuntimeError:
+                # The entity is not accessible. See TimelineObjectInfo.entity.
+                pass
+        if self.pending:
+            app.fireCustomEvent(self.EVENT_ID)
+
+selection_prewarmer = SelectionPrewarmer()
+
+def register_custom_event(event_id, handler):
+    # Make sure an event from a bad stop is not left behind
+    app.unregisterCustomEvent(event_id)
+    event = app.registerCustomEvent(event_id)
+    events_manager.add_handler(event,
+                               adsk.core.CustomEventHandler,
+                               handler)
+    return event
 
 def trace_feature_image(command_terminated_event_args):
     ''' Development function to trace feature images '''
@@ -753,7 +2277,7 @@ def trace_feature_image(command_terminated_event_args):
 def workspace_pre_deactivate_handler(args):
     #eventArgs = adsk.core.DocumentEventArgs.cast(args)
     if get_enabled():
-        invalidate(clear=True)
+        document_cache.leave_document()
 
 def workspace_activated_handler(args):
     #eventArgs = adsk.core.WorkspaceEventArgs.cast(args)
@@ -771,4 +2295,331 @@ def document_activated_handler(args):
         if get_enabled():
             show_palette()
 
-#########################################################################################
\ No newline at end of file
+# (Document, key) of the documents that have never been saved. Their names
+# are not unique, e.g. "Untitled", so they are told apart by the objects.
+unsaved_document_keys = []
+next_unsaved_document_key = 1
+
+def get_active_document_key():
+    '''Returns a key that identifies the active document.'''
+    global unsaved_document_keys, next_unsaved_document_key
+    document = app.activeDocument
+    if not document:
+        return None
+    data_file = document.dataFile
+    if data_file:
+        return data_file.id
+    # Forget closed documents
+    unsaved_document_keys = [(known_document, key) for known_document, key in unsaved_document_keys
+                             if known_document.isValid]
+    for known_document, key in unsaved_document_keys:
+        if known_document == document:
+            return key
+    key = f'unsaved:{next_unsaved_document_key}'
+    next_unsaved_document_key += 1
+    unsaved_document_keys.append((document, key))
+    return key
+
+def get_active_document_version():
+    '''Returns the version number of the active document, or None if it has
+    never been saved.'''
+    document = app.activeDocument
+    data_file = document.dataFile if document else None
+    if not data_file:
+        return None
+    return data_file.versionNumber
+
+def get_saved_document_version(design):
+    '''Returns the data file ID and version number of the document of the
+    design, or None if it has never been saved or has been closed.'''
+    try:
+        if not design.isValid:
+            return None
+        data_file = design.parentDocument.dataFile
+        if not data_file:
+            return None
+        return data_file.id, data_file.versionNumber
+    except RuntimeError:
+        return None
+
+class DocumentState:
+    '''The timeline state of a document, as last sent to the palette.'''
+    def __init__(self, design):
+        # The nodes and the snapshot are only valid for this design
+        self.design = design
+        self.snapshot = timeline_snapshot
+        self.cache_tree = timeline_cache_tree
+        self.cache_map = timeline_cache_map
+        self.item_count = timeline_item_count
+        self.marker_position = timeline_marker_position
+        self.component_hierarchy = component_hierarchy
+        self.feature_details = dict(feature_details_cache)
+
+    def restore(self):
+        global timeline_snapshot, timeline_cache_tree, timeline_cache_map
+        global timeline_item_count, timeline_marker_position, component_hierarchy
+        timeline_snapshot = self.snapshot
+        timeline_cache_tree = self.cache_tree
+        timeline_cache_map = self.cache_map
+        timeline_item_count = self.item_count
+        timeline_marker_position = self.marker_position
+        component_hierarchy = self.component_hierarchy
+        recheck_component_hierarchy()
+        feature_details_cache.clear()
+        feature_details_cache.update(self.feature_details)
+
+class DocumentCache:
+    '''Keeps the timelines of the last shown documents, so that switching
+    back to a document shows its timeline right away. The timeline is then
+    checked using timeline_changed() and patched if needed.
+
+    The least recently shown documents are evicted when there are more than
+    document_cache_size documents or document_cache_max_rows rows.'''
+    def __init__(self):
+        # Document key -> DocumentState, least recently used first
+        self.states = OrderedDict()
+        # Key, version and design of the document that the palette shows
+        self.current_key = None
+        self.current_version = None
+        self.current_design = None
+        self.counters = { 'hits': 0, 'misses': 0, 'evictions': 0 }
+
+    def set_current(self, key):
+        self.current_key = key
+        self.current_version = get_active_document_version() if key is not None else None
+        self.current_design = app.activeProduct if key is not None else None
+
+    def leave_document(self):
+        '''Stores the state of the shown document and clears the palette.'''
+        global timeline_snapshot, timeline_cache_tree, timeline_cache_map
+        self.store_current()
+        self.set_current(None)
+        invalidate(clear=True)
+        # Nothing for the next document to be patched against. This lets a
+        # large timeline be streamed.
+        timeline_snapshot = None
+        timeline_cache_tree = None
+        timeline_cache_map = None
+
+    def store_current(self):
+        if (self.current_key is None or timeline_snapshot is None or
+            not timeline_snapshot.rows or palette_stale):
+            # Nothing shown, still streaming or not checked yet
+            return
+        self.save_current()
+        if settings['document_cache_size'] <= 0:
+            return
+        self.states.pop(self.current_key, None)
+        self.states[self.current_key] = DocumentState(self.current_design)
+        self.evict()
+
+    def save_current(self):
+        '''Writes the shown timeline to the disk cache, if enabled.
+
+        The version is read now, as the document can have been saved since
+        it was shown.'''
+        if (not settings['disk_cache'] or self.current_design is None or
+            timeline_snapshot is None or not timeline_snapshot.rows or palette_stale):
+            return
+        saved_version = get_saved_document_version(self.current_design)
+        if not saved_version:
+            return
+        key, version = saved_version
+        disk_cache.store(key, version, timeline_snapshot)
+
+    def show_active_document(self):
+        global palette_stale
+        key = get_active_document_key()
+        if key == self.current_key and app.activeProduct == self.current_design:
+            invalidate()
+            return
+
+        self.store_current()
+        self.set_current(key)
+        state = self.states.pop(key, None)
+        if state and state.design != app.activeProduct:
+            # Another design behind the same key. timeline_changed() only
+            # compares the counts for it, so the state cannot be trusted.
+            state = None
+        if not state:
+            self.counters['misses'] += 1
+            html_command = self.show_from_disk()
+            palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
+            if html_command and palette and html_ready:
+                palette.sendInfoToHTML(html_command['action'], json.dumps(html_command['data']))
+                # Let the palette show it before walking the timeline
+                refresh_scheduler.request_later()
+            else:
+                invalidate()
+            return
+
+        self.counters['hits'] += 1
+        timeline_stream.cancel()
+        state.restore()
+        palette_stale = False
+        palette = ui.palettes.itemById('thomasa88_verticalTimelinePalette')
+        if palette and html_ready:
+            html_command = make_set_timeline_command(timeline_snapshot)
+            palette.sendInfoToHTML(html_command['action'], json.dumps(html_command['data']))
+        if timeline_changed():
+            invalidate()
+
+    def evict(self):
+        max_documents = settings['document_cache_size']
+        max_rows = settings['document_cache_max_rows']
+        row_count = sum(len(state.snapshot.rows) for state in self.states.values())
+        while self.states and (len(self.states) > max_documents or row_count > max_rows):
+            key, state = self.states.popitem(last=False)
+            row_count -= len(state.snapshot.rows)
+            self.counters['evictions'] += 1
+            print(f'Evicted the cached timeline of document {key} ({len(state.snapshot.rows)} rows)')
+
+    def show_from_disk(self):
+        '''Makes the timeline of the current document in the disk cache the
+        palette snapshot. Returns the command that shows it, marked as stale,
+        or None if there is none. The caller must refresh afterwards.'''
+        global timeline_snapshot, palette_stale
+        if not settings['disk_cache'] or self.current_version is None:
+            return None
+        snapshot = disk_cache.load(self.current_key, self.current_version)
+        if not snapshot:
+            return None
+        timeline_stream.cancel()
+        # Belongs to whatever was shown before
+        feature_details_cache.clear()
+        timeline_snapshot = snapshot
+        palette_stale = True
+        html_command = make_set_timeline_command(snapshot)
+        html_command['data']['stale'] = True
+        return html_command
+
+document_cache = DocumentCache()
+
+# Version of the disk cache file contents. Files of other versions are ignored.
+# 2: Image keys instead of image paths.
+DISK_CACHE_SCHEMA = 2
+
+class DiskCache:
+    '''Stores the last shown timeline of saved documents on disk, so that it
+    can be shown while the timeline is walked the first time the document is
+    shown in a session.
+
+    There is one file per document and version, with the snapshot rows as
+    zlib compressed JSON. Files are written to a temporary file first and
+    then moved in place, so that a crash cannot leave a broken file behind.
+    Unreadable files are deleted. The least recently used files are deleted
+    when the files take more than disk_cache_max_mb.'''
+    def __init__(self, path):
+        self.path = path
+        self.counters = { 'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0 }
+        # File path -> weak reference to the snapshot that was last written
+        # to it, to not write unchanged snapshots again
+        self.written = {}
+
+    def get_file_path(self, key, version):
+        name = hashlib.sha1(f'{key}@{version}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.vtc')
+
+    def load(self, key, version):
+        path = self.get_file_path(key, version)
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+            if (data['schema'] != DISK_CACHE_SCHEMA or
+                data['key'] != key or data['version'] != version):
+                raise ValueError('Wrong schema or document')
+            snapshot = TimelineSnapshot(data['rows'], data['max-parents'], data['message'])
+        except FileNotFoundError:
+            self.counters['misses'] += 1
+            return None
+        except Exception as e:
+            print(f'Deleting unreadable disk cache file {path}: {e}')
+            self.counters['errors'] += 1
+            self.remove(path)
+            return None
+        try:
+            # Used for the least recently used order
+            os.utime(path)
+        except OSError:
+            pass
+        self.written[path] = weakref.ref(snapshot)
+        self.counters['hits'] += 1
+        return snapshot
+
+    def store(self, key, version, snapshot):
+        path = self.get_file_path(key, version)
+        written = self.written.get(path)
+        if written and written() is snapshot:
+            return
+        data = {
+            'schema': DISK_CACHE_SCHEMA,
+            'key': key,
+            'version': version,
+            'max-parents': snapshot.max_parents,
+            'message': snapshot.message,
+            'rows': snapshot.rows,
+        }
+        tmp_path = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'Failed to write disk cache file {path}: {e}')
+            self.counters['errors'] += 1
+            if tmp_path:
+                self.remove(tmp_path)
+            return
+        self.written[path] = weakref.ref(snapshot)
+        self.counters['writes'] += 1
+        self.trim()
+
+    def trim(self):
+        max_size = settings['disk_cache_max_mb'] * 1024 * 1024
+        files = []
+        try:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.vtc'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            print(f'Failed to list the disk cache: {e}')
+            return
+        total_size = sum(size for _, size, _ in files)
+        # Oldest first
+        files.sort()
+        for _, size, path in files:
+            if total_size <= max_size:
+                break
+            print(f'Evicted disk cache file {path} ({size} bytes)')
+            self.remove(path)
+            total_size -= size
+
+    def remove(self, path):
+        self.written.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def get_disk_cache_path():
+    '''Returns the folder of the disk cache. It is kept in the application
+    data of the user, not in the add-in folder, which can be replaced when
+    the add-in is updated.'''
+    if sys.platform == 'win32':
+        data_path = os.getenv('APPDATA') or os.path.expanduser('~')
+    else:
+        # Mac
+        data_path = os.path.expanduser('~/Library/Application Support')
+    return os.path.join(data_path, 'thomasa88', 'VerticalTimeline', 'timeline_cache')
+
+disk_cache = DiskCache(get_disk_cache_path())
+
+#########################################################################################
+
+# Last, to include the whole module
+startup_timing['import-ms'] = round((time.perf_counter() - LOAD_START_TIME) * 1000, 3)
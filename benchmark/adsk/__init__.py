@@ -0,0 +1,11 @@
+# This file is part of VerticalTimeline, a Fusion 360 add-in that
+# provides a vertical timeline.
+#
+# Copyright (C) 2020  Thomas Axelsson
+#
+# This work is dual-licensed under GPL 3.0 (or any later version) and MIT.
+# You can choose between one of them if you use this work.
+
+# Stand-in for the Fusion 360 adsk module, used to run the add-in outside
+# Fusion in the benchmark. Only the parts of the API that the add-in uses
+# are implemented.
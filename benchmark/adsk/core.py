@@ -0,0 +1,441 @@
+# This file is part of VerticalTimeline, a Fusion 360 add-in that
+# provides a vertical timeline.
+#
+# Copyright (C) 2020  Thomas Axelsson
+#
+# This work is dual-licensed under GPL 3.0 (or any later version) and MIT.
+# You can choose between one of them if you use this work.
+
+# Stand-in for adsk.core. Every property access and method call on an API
+# object is counted, to show how much the add-in talks to Fusion. Each call
+# can also be given a fixed cost, to mimic the overhead of the real API.
+
+from collections import Counter
+import time
+
+# "Class.member" -> number of calls
+call_counts = Counter()
+# Seconds added to each call
+call_latency = 0.0
+
+def api_call(key):
+    call_counts[key] += 1
+    if call_latency:
+        end = time.perf_counter() + call_latency
+        while time.perf_counter() < end:
+            pass
+
+def reset_call_counts():
+    call_counts.clear()
+
+class ApiProperty:
+    '''Counted property, stored in the "_<name>" attribute of the object.
+
+    If the stored value is an exception, it is raised instead, like
+    Fusion does for some entities.'''
+    def __init__(self, writable=False):
+        self.writable = writable
+
+    def __set_name__(self, owner, name):
+        self.slot = '_' + name
+        self.key = f'{owner.__name__}.{name}'
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        api_call(self.key)
+        value = getattr(obj, self.slot)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def __set__(self, obj, value):
+        if not self.writable:
+            raise AttributeError(f'{self.key} is read-only')
+        api_call(self.key + '=')
+        setattr(obj, self.slot, value)
+
+def api_method(func):
+    '''Counts calls of an API method.'''
+    key = func.__qualname__
+    def wrapper(*args, **kwargs):
+        api_call(key)
+        return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__qualname__ = func.__qualname__
+    return wrapper
+
+class Base:
+    _namespace = 'core'
+
+    @classmethod
+    def classType(cls):
+        api_call('Base.classType')
+        return f'adsk::{cls._namespace}::{cls.__name__}'
+
+    @classmethod
+    def cast(cls, obj):
+        api_call('Base.cast')
+        return obj if isinstance(obj, cls) else None
+
+    @property
+    def objectType(self):
+        return self.classType()
+
+    @property
+    def isValid(self):
+        return True
+
+class Collection(Base):
+    '''A read-only API collection.'''
+    def __init__(self, items=None):
+        self._items = items if items is not None else []
+
+    @property
+    def count(self):
+        api_call(type(self).__name__ + '.count')
+        return len(self._items)
+
+    @api_method
+    def item(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        for item in self._items:
+            api_call(type(self).__name__ + '.item')
+            yield item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        api_call(type(self).__name__ + '.item')
+        return self._items[index]
+
+class ObjectCollection(Collection):
+    @staticmethod
+    def create():
+        api_call('ObjectCollection.create')
+        return ObjectCollection()
+
+    @api_method
+    def add(self, item):
+        self._items.append(item)
+        return True
+
+####################################################################
+# Events
+
+class EventHandler:
+    def __init__(self):
+        pass
+
+    def notify(self, args):
+        pass
+
+class CommandCreatedEventHandler(EventHandler): pass
+class CommandEventHandler(EventHandler): pass
+class ApplicationCommandEventHandler(EventHandler): pass
+class DocumentEventHandler(EventHandler): pass
+class WorkspaceEventHandler(EventHandler): pass
+class HTMLEventHandler(EventHandler): pass
+class UserInterfaceGeneralEventHandler(EventHandler): pass
+class CustomEventHandler(EventHandler): pass
+
+class Event(Base):
+    def __init__(self, name=''):
+        self.name = name
+        self.handlers = []
+
+    def add(self, handler):
+        self.handlers.append(handler)
+        return True
+
+    def remove(self, handler):
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+        return True
+
+    def fire(self, args):
+        for handler in list(self.handlers):
+            handler.notify(args)
+
+class EventArgs(Base):
+    pass
+
+class HTMLEventArgs(EventArgs):
+    action = ApiProperty()
+    data = ApiProperty()
+    returnData = ApiProperty(writable=True)
+
+    def __init__(self, action, data):
+        self._action = action
+        self._data = data
+        self._returnData = ''
+
+class ApplicationCommandEventArgs(EventArgs):
+    commandId = ApiProperty()
+    terminationReason = ApiProperty()
+
+    def __init__(self, command_id, termination_reason):
+        self._commandId = command_id
+        self._terminationReason = termination_reason
+
+class CustomEventArgs(EventArgs):
+    additionalInfo = ApiProperty()
+
+    def __init__(self, additional_info=''):
+        self._additionalInfo = additional_info
+
+class CommandTerminationReason:
+    UnknownTerminationReason = 0
+    CompletedTerminationReason = 1
+    CancelledTerminationReason = 2
+    AbortedTerminationReason = 3
+    PreEmptedTerminationReason = 4
+    SessionEndingTerminationReason = 5
+
+class PaletteDockingStates:
+    PaletteDockStateFloating = 0
+    PaletteDockStateTop = 1
+    PaletteDockStateBottom = 2
+    PaletteDockStateLeft = 3
+    PaletteDockStateRight = 4
+
+####################################################################
+# User interface
+
+class Palette(Base):
+    isVisible = ApiProperty(writable=True)
+    dockingState = ApiProperty(writable=True)
+
+    def __init__(self, id, name, html_file):
+        self.id = id
+        self.name = name
+        self.htmlFileURL = html_file
+        self._isVisible = True
+        self._dockingState = PaletteDockingStates.PaletteDockStateFloating
+        self.incomingFromHTML = Event('incomingFromHTML')
+        self.closed = Event('closed')
+        self.navigatingURL = Event('navigatingURL')
+        # (action, data) sent to the HTML, for the benchmark to inspect
+        self.sent = []
+        self.deleted = False
+
+    @api_method
+    def sendInfoToHTML(self, action, data):
+        self.sent.append((action, data))
+        return ''
+
+    @api_method
+    def deleteMe(self):
+        self.deleted = True
+        return True
+
+    def send_from_html(self, action, data):
+        '''Simulates a call to adsk.fusionSendData() in the palette.
+        Returns the return data.'''
+        args = HTMLEventArgs(action, data)
+        self.incomingFromHTML.fire(args)
+        return args._returnData
+
+class Palettes(Collection):
+    @api_method
+    def itemById(self, id):
+        for palette in self._items:
+            if palette.id == id:
+                return palette
+        return None
+
+    @api_method
+    def add(self, id, name, html_file, is_visible, show_close_button,
+            is_resizable, width=0, height=0, use_new_web_browser=False):
+        palette = Palette(id, name, html_file)
+        palette._isVisible = is_visible
+        self._items.append(palette)
+        return palette
+
+class CommandDefinition(Base):
+    def __init__(self, id, name='', tooltip='', resource_folder=''):
+        self.id = id
+        self.name = name
+        self.tooltip = tooltip
+        self.resourceFolder = resource_folder
+        self.commandCreated = Event('commandCreated')
+        self.executions = 0
+        self.deleted = False
+
+    @api_method
+    def execute(self):
+        self.executions += 1
+        return True
+
+    @api_method
+    def deleteMe(self):
+        self.deleted = True
+        return True
+
+class CommandDefinitions(Collection):
+    @api_method
+    def itemById(self, id):
+        for command_definition in self._items:
+            if command_definition.id == id and not command_definition.deleted:
+                return command_definition
+        return None
+
+    @api_method
+    def addButtonDefinition(self, id, name, tooltip, resource_folder=''):
+        command_definition = CommandDefinition(id, name, tooltip, resource_folder)
+        self._items.append(command_definition)
+        return command_definition
+
+class ToolbarControl(Base):
+    def __init__(self, id, controls=None):
+        self.id = id
+        self.controls = controls
+        self.deleted = False
+
+    @api_method
+    def deleteMe(self):
+        self.deleted = True
+        return True
+
+class ToolbarControls(Collection):
+    @api_method
+    def itemById(self, id):
+        for control in self._items:
+            if control.id == id and not control.deleted:
+                return control
+        return None
+
+    @api_method
+    def addCommand(self, command_definition, position_id='', is_before=True):
+        control = ToolbarControl(command_definition.id)
+        self._items.append(control)
+        return control
+
+class Toolbar(Base):
+    def __init__(self, id, controls):
+        self.id = id
+        self.controls = controls
+
+class Toolbars(Collection):
+    @api_method
+    def itemById(self, id):
+        for toolbar in self._items:
+            if toolbar.id == id:
+                return toolbar
+        return None
+
+class Workspace(Base):
+    def __init__(self, id):
+        self.id = id
+
+class Selections(Base):
+    all = ApiProperty(writable=True)
+
+    def __init__(self):
+        self._all = ObjectCollection()
+
+class UserInterface(Base):
+    activeWorkspace = ApiProperty()
+    activeSelections = ApiProperty()
+
+    def __init__(self):
+        self.palettes = Palettes()
+        self.commandDefinitions = CommandDefinitions()
+        view_controls = ToolbarControls()
+        file_controls = ToolbarControls([ToolbarControl('ViewWidgetCommand', view_controls)])
+        self.toolbars = Toolbars([Toolbar('QAT', ToolbarControls([ToolbarControl('FileSubMenuCommand', file_controls)]))])
+        self._activeWorkspace = Workspace('FusionSolidEnvironment')
+        self._activeSelections = Selections()
+        self.commandTerminated = Event('commandTerminated')
+        self.commandStarting = Event('commandStarting')
+        self.workspacePreDeactivate = Event('workspacePreDeactivate')
+        self.workspaceActivated = Event('workspaceActivated')
+        # Messages that would have been shown to the user
+        self.messages = []
+
+    @api_method
+    def messageBox(self, text, title='', buttons=0, icon=0):
+        self.messages.append(text)
+        return 0
+
+    @api_method
+    def terminateActiveCommand(self):
+        return True
+
+####################################################################
+# Documents
+
+class DataFile(Base):
+    id = ApiProperty()
+    versionNumber = ApiProperty()
+
+    def __init__(self, id, version_number=1):
+        self._id = id
+        self._versionNumber = version_number
+
+class Document(Base):
+    name = ApiProperty()
+    # None for documents that have never been saved
+    dataFile = ApiProperty()
+
+    def __init__(self, name, data_file=None):
+        self._name = name
+        self._dataFile = data_file
+
+####################################################################
+# Application
+
+class Application(Base):
+    activeProduct = ApiProperty()
+    activeDocument = ApiProperty()
+    isStartupComplete = ApiProperty()
+
+    _instance = None
+
+    def __init__(self):
+        self.userInterface = UserInterface()
+        self._activeProduct = None
+        self._activeDocument = None
+        self._isStartupComplete = True
+        self.documentActivated = Event('documentActivated')
+        self.documentOpened = Event('documentOpened')
+        self.custom_events = {}
+        # Fired custom events, waiting to be handled by process_events()
+        self.fired_events = []
+
+    @staticmethod
+    def get():
+        if not Application._instance:
+            Application._instance = Application()
+        return Application._instance
+
+    @api_method
+    def registerCustomEvent(self, event_id):
+        event = Event(event_id)
+        self.custom_events[event_id] = event
+        return event
+
+    @api_method
+    def unregisterCustomEvent(self, event_id):
+        return self.custom_events.pop(event_id, None) is not None
+
+    @api_method
+    def fireCustomEvent(self, event_id, additional_info=''):
+        # Fusion handles the event later, from the main thread
+        self.fired_events.append((event_id, additional_info))
+        return True
+
+    def process_events(self):
+        '''Handles fired custom events, including events fired by the
+        handlers, until there are none left. Returns the number of events.'''
+        handled = 0
+        while self.fired_events:
+            event_id, additional_info = self.fired_events.pop(0)
+            event = self.custom_events.get(event_id)
+            if event:
+                event.fire(CustomEventArgs(additional_info))
+                handled += 1
+        return handled
@@ -0,0 +1,256 @@
+# This file is part of VerticalTimeline, a Fusion 360 add-in that
+# provides a vertical timeline.
+#
+# Copyright (C) 2020  Thomas Axelsson
+#
+# This work is dual-licensed under GPL 3.0 (or any later version) and MIT.
+# You can choose between one of them if you use this work.
+
+# Stand-in for adsk.fusion. The objects are plain containers, filled in by
+# benchmark/synthetic.py.
+
+from .core import ApiProperty, Base, Collection, api_method
+
+class FusionBase(Base):
+    _namespace = 'fusion'
+
+class DesignTypes:
+    DirectDesignType = 0
+    ParametricDesignType = 1
+
+class Design(FusionBase):
+    rootComponent = ApiProperty()
+    allComponents = ApiProperty()
+    timeline = ApiProperty()
+    designType = ApiProperty()
+    parentDocument = ApiProperty()
+
+    def __init__(self):
+        self._parentDocument = None
+        self._rootComponent = None
+        self._allComponents = Components()
+        self._timeline = None
+        self._designType = DesignTypes.ParametricDesignType
+
+class Components(Collection):
+    pass
+
+class Component(FusionBase):
+    name = ApiProperty(writable=True)
+    id = ApiProperty()
+    entityToken = ApiProperty()
+    occurrences = ApiProperty()
+    allOccurrences = ApiProperty()
+    bRepBodies = ApiProperty()
+    parentDesign = ApiProperty()
+
+    def __init__(self, design, name, token):
+        self._name = name
+        # Persistent ID. Fusion's entity tokens can differ between reads, but
+        # the stand-in keeps them the same.
+        self._id = token
+        self._entityToken = token
+        self._occurrences = OccurrenceList()
+        # Kept up to date by the generator, for the root component
+        self._allOccurrences = OccurrenceList()
+        self._bRepBodies = Collection()
+        self._parentDesign = design
+
+    @api_method
+    def allOccurrencesByComponent(self, component):
+        return OccurrenceList([occurrence for occurrence in self._allOccurrences._items
+                               if occurrence._component is component])
+
+class Occurrences(Collection):
+    pass
+
+class OccurrenceList(Collection):
+    pass
+
+class Occurrence(FusionBase):
+    name = ApiProperty()
+    component = ApiProperty()
+    sourceComponent = ApiProperty()
+    childOccurrences = ApiProperty()
+    fullPathName = ApiProperty()
+    entityToken = ApiProperty()
+    isReferencedComponent = ApiProperty()
+    assemblyContext = ApiProperty()
+
+    def __init__(self, component, source_component, token):
+        self._name = f'{component._name}:1'
+        self._component = component
+        self._sourceComponent = source_component
+        self._childOccurrences = component._occurrences
+        self._fullPathName = self._name
+        self._entityToken = token
+        self._isReferencedComponent = False
+        self._assemblyContext = None
+
+    @api_method
+    def createForAssemblyContext(self, occurrence):
+        return self
+
+class BRepBody(FusionBase):
+    name = ApiProperty()
+    parentComponent = ApiProperty()
+
+    def __init__(self, name, component):
+        self._name = name
+        self._parentComponent = component
+
+    @api_method
+    def createForAssemblyContext(self, occurrence):
+        return self
+
+class Feature(FusionBase):
+    name = ApiProperty()
+    parentComponent = ApiProperty()
+    bodies = ApiProperty()
+    isSolid = ApiProperty()
+
+    def __init__(self, name, component):
+        self._name = name
+        self._parentComponent = component
+        self._bodies = Collection([BRepBody(f'Body of {name}', component)])
+        self._isSolid = True
+
+    @api_method
+    def createForAssemblyContext(self, occurrence):
+        return self
+
+class ExtrudeFeature(Feature): pass
+class RevolveFeature(Feature): pass
+class LoftFeature(Feature): pass
+class SweepFeature(Feature): pass
+class FilletFeature(Feature): pass
+class ChamferFeature(Feature): pass
+class ShellFeature(Feature): pass
+class HoleFeature(Feature): pass
+class BoxFeature(Feature): pass
+class CombineFeature(Feature): pass
+class RectangularPatternFeature(Feature): pass
+class MirrorFeature(Feature): pass
+class SplitBodyFeature(Feature): pass
+
+class Sketch(FusionBase):
+    name = ApiProperty()
+    parentComponent = ApiProperty()
+
+    def __init__(self, name, component):
+        self._name = name
+        self._parentComponent = component
+
+    @api_method
+    def createForAssemblyContext(self, occurrence):
+        return self
+
+class Joint(FusionBase):
+    name = ApiProperty()
+    parentComponent = ApiProperty()
+
+    def __init__(self, name, component):
+        self._name = name
+        self._parentComponent = component
+
+    @api_method
+    def createForAssemblyContext(self, occurrence):
+        return self
+
+class ConstructionPlaneOffsetDefinition(FusionBase): pass
+class ConstructionPlaneMidplaneDefinition(FusionBase): pass
+
+class ConstructionPlane(FusionBase):
+    name = ApiProperty()
+    parent = ApiProperty()
+    definition = ApiProperty()
+
+    def __init__(self, name, component, definition):
+        self._name = name
+        self._parent = component
+        self._definition = definition
+
+    @api_method
+    def createForAssemblyContext(self, occurrence):
+        return self
+
+class TimelineObject(FusionBase):
+    name = ApiProperty(writable=True)
+    index = ApiProperty()
+    isGroup = ApiProperty()
+    isSuppressed = ApiProperty(writable=True)
+    isRolledBack = ApiProperty()
+    parentGroup = ApiProperty()
+    entity = ApiProperty()
+
+    def __init__(self, timeline, name, entity):
+        self.timeline = timeline
+        self._name = name
+        self._index = -1
+        self._isGroup = False
+        self._isSuppressed = False
+        self._isRolledBack = False
+        self._parentGroup = None
+        # An exception, for entities that Fusion does not give access to
+        self._entity = entity
+
+    @api_method
+    def rollTo(self, is_before):
+        self.timeline.roll_to(self, is_before)
+        return True
+
+class TimelineGroup(TimelineObject):
+    isCollapsed = ApiProperty(writable=True)
+
+    def __init__(self, timeline, name):
+        super().__init__(timeline, name, RuntimeError('Groups have no entity'))
+        self._isGroup = True
+        self._isCollapsed = True
+        self.children = []
+
+    @property
+    def count(self):
+        return len(self.children)
+
+    @api_method
+    def item(self, index):
+        return self.children[index]
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, index):
+        return self.children[index]
+
+class TimelineGroups(Collection):
+    pass
+
+class Timeline(Collection):
+    '''The top level of the timeline. Groups are always collapsed, so the
+    objects in them are only reached through the groups.'''
+    markerPosition = ApiProperty(writable=True)
+    timelineGroups = ApiProperty()
+
+    def __init__(self):
+        super().__init__()
+        # All objects except groups, in timeline order
+        self.features = []
+        self._markerPosition = 0
+        self._timelineGroups = TimelineGroups()
+
+    def roll_to(self, obj, is_before):
+        while obj._isGroup:
+            obj = obj.children[0] if is_before else obj.children[-1]
+        position = self.features.index(obj)
+        self._markerPosition = position if is_before else position + 1
+        self.update_rolled_back()
+
+    def update_rolled_back(self):
+        for i, obj in enumerate(self.features):
+            obj._isRolledBack = (i >= self._markerPosition)
+        # Inner groups are created after their parents
+        for group in reversed(self._timelineGroups._items):
+            group._isRolledBack = all(child._isRolledBack for child in group.children)
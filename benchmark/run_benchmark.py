@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+# This file is part of VerticalTimeline, a Fusion 360 add-in that
+# provides a vertical timeline.
+#
+# Copyright (C) 2020  Thomas Axelsson
+#
+# This work is dual-licensed under GPL 3.0 (or any later version) and MIT.
+# You can choose between one of them if you use this work.
+
+'''Runs the add-in outside Fusion, against synthetic timelines, and reports
+latency percentiles, adsk calls, JSON bytes and peak memory per scenario.
+
+The add-in is loaded the same way as in Fusion, so the thomasa88lib
+submodule must be checked out. adsk is replaced by the stand-in in
+benchmark/adsk.
+
+Example:
+  python benchmark/run_benchmark.py --sizes 100,1000,10000 --group-ratios 0,0.01,0.1
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+ADDIN_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Use the adsk stand-in
+sys.path.insert(0, BENCHMARK_DIR)
+import adsk.core, adsk.fusion
+import synthetic
+
+PALETTE_ID = 'thomasa88_verticalTimelinePalette'
+
+class BenchmarkError(Exception):
+    pass
+
+class NullWriter:
+    '''Swallows the add-in prints, that would otherwise dominate the
+    timings.'''
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+def load_addin():
+    # Fusion loads the add-in as a package, so that it can import its
+    # submodules relative to itself
+    spec = importlib.util.spec_from_file_location(
+        'VerticalTimeline', os.path.join(ADDIN_DIR, 'VerticalTimeline.py'),
+        submodule_search_locations=[ADDIN_DIR])
+    addin = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = addin
+    spec.loader.exec_module(addin)
+    return addin
+
+class Context:
+    def __init__(self, addin, spec):
+        self.addin = addin
+        self.spec = spec
+        self.app = adsk.core.Application.get()
+        self.ui = self.app.userInterface
+        self.rng = random.Random(spec.seed)
+        self.design = synthetic.build_design(spec)
+        synthetic.set_active_design(self.design)
+        self.palette = self.ui.palettes.itemById(PALETTE_ID)
+
+    def send_from_html(self, action, data={}):
+        return_data = self.palette.send_from_html(action, json.dumps(data))
+        self.check_errors()
+        return return_data
+
+    def fire_command(self, command_id):
+        '''Simulates a completed Fusion command. The refresh is done right
+        away, instead of after the refresh delay.'''
+        args = adsk.core.ApplicationCommandEventArgs(
+            command_id, adsk.core.CommandTerminationReason.CompletedTerminationReason)
+        self.ui.commandTerminated.fire(args)
+        scheduler = self.addin.refresh_scheduler
+        with scheduler.lock:
+            scheduler._cancel_timer()
+        scheduler.custom_event_handler(None)
+        self.check_errors()
+
+    def check_errors(self):
+        if self.ui.messages:
+            messages = '\n'.join(self.ui.messages)
+            self.ui.messages.clear()
+            raise BenchmarkError(f'The add-in reported an error:\n{messages}')
+
+    def feature_ids(self):
+        return [node_id for node_id, node in self.addin.timeline_cache_map.items()
+                if node.obj and not node.children]
+
+####################################################################
+# Scenarios
+#
+# Each scenario returns (setup, run). setup is called before each run,
+# outside the timing. run returns data returned to the palette, if any.
+
+def scenario_build_timeline_tree(ctx):
+    def run():
+        flat_timeline = ctx.addin.thomasa88lib.timeline.flatten_timeline(ctx.design.timeline)
+        ctx.addin.build_timeline_tree(flat_timeline)
+    return None, run
+
+def scenario_component_hierarchy(ctx):
+    def setup():
+        ctx.addin.invalidate_component_hierarchy()
+    def run():
+        ctx.addin.get_component_hierarchy()
+    return setup, run
+
+def scenario_open(ctx):
+    # The palette has just been loaded and asks for the whole timeline.
+    # Includes all chunks, if the timeline is streamed.
+    def setup():
+        ctx.addin.invalidate_component_hierarchy()
+    def run():
+        return_data = ctx.send_from_html('ready')
+        ctx.app.process_events()
+        ctx.check_errors()
+        return return_data
+    return setup, run
+
+def scenario_open_cached(ctx):
+    # Like open, with the timeline in the disk cache. Only the time until
+    # the stored timeline is returned to the palette is measured.
+    def setup():
+        # The previous run checks the timeline from the event loop
+        ctx.app.process_events()
+        ctx.check_errors()
+        ctx.addin.settings['disk_cache'] = True
+        ctx.addin.document_cache.save_current()
+        ctx.addin.invalidate_component_hierarchy()
+    def run():
+        return_data = ctx.send_from_html('ready')
+        ctx.addin.settings['disk_cache'] = False
+        return return_data
+    return setup, run
+
+def scenario_refresh_unchanged(ctx):
+    # E.g. a command that did not change the timeline
+    def run():
+        ctx.addin.invalidate()
+    return None, run
+
+def scenario_refresh_renamed(ctx):
+    # One feature has been renamed in the Fusion timeline
+    objects = ctx.design.timeline.features
+    def setup():
+        obj = ctx.rng.choice(objects)
+        obj._name = obj._name.rstrip('*') if obj._name.endswith('*') else obj._name + '*'
+    def run():
+        ctx.addin.invalidate()
+    return setup, run
+
+def scenario_roll_to(ctx):
+    # The user right-clicks in the palette, to roll the timeline
+    ids = ctx.feature_ids()
+    targets = [ids[len(ids) // 2], ids[-1]]
+    def run():
+        targets.reverse()
+        return ctx.send_from_html('rollToFeature', { 'id': targets[0] })
+    return None, run
+
+def scenario_rename(ctx):
+    ids = ctx.feature_ids()
+    def run():
+        return ctx.send_from_html('setFeatureName', { 'id': ctx.rng.choice(ids),
+                                                      'value': f'Renamed{ctx.rng.randint(0, 1000)}' })
+    return None, run
+
+def scenario_select(ctx):
+    # Fusion does not let us select objects without an accessible entity
+    ids = [node_id for node_id in ctx.feature_ids()
+           if not isinstance(ctx.addin.timeline_cache_map[node_id].obj._entity, Exception)]
+    def run():
+        return ctx.send_from_html('selectFeature', { 'id': ctx.rng.choice(ids) })
+    return None, run
+
+def scenario_select_many(ctx):
+    # The user selects 50 rows in the palette, with Shift+click
+    ids = [node_id for node_id in ctx.feature_ids()
+           if not isinstance(ctx.addin.timeline_cache_map[node_id].obj._entity, Exception)]
+    def run():
+        start = ctx.rng.randrange(max(1, len(ids) - 50))
+        return ctx.send_from_html('selectFeatures', { 'ids': ids[start:start + 50] })
+    return None, run
+
+def scenario_switch_document(ctx):
+    # The user switches to another open design of the same size, and back
+    other_spec = synthetic.TimelineSpec(**vars(ctx.spec))
+    other_spec.seed += 1
+    other_design = synthetic.build_design(other_spec)
+    def switch_to(design):
+        ctx.addin.document_cache.leave_document()
+        synthetic.set_active_design(design)
+        ctx.addin.show_palette()
+        ctx.app.process_events()
+        ctx.check_errors()
+    def run():
+        switch_to(other_design)
+        switch_to(ctx.design)
+    return None, run
+
+def scenario_new_command(ctx):
+    # A command that has not been seen before, and that does not change the
+    # timeline. E.g. orbiting the view.
+    command_ids = (f'BenchmarkViewCommand{i}' for i in range(1000000))
+    def run():
+        ctx.fire_command(next(command_ids))
+    return None, run
+
+def scenario_known_command(ctx):
+    # The same command again, e.g. toggling visibility
+    def run():
+        ctx.fire_command('BenchmarkVisibilityCommand')
+    return None, run
+
+def scenario_feature_details(ctx):
+    # The palette asks for the details of the rows in view
+    ids = ctx.feature_ids()
+    def setup():
+        ctx.addin.feature_details_cache.clear()
+    def run():
+        start = ctx.rng.randrange(max(1, len(ids) - 50))
+        return ctx.send_from_html('getFeatureDetails',
+                                  { 'ids': [str(node_id) for node_id in ids[start:start + 50]] })
+    return setup, run
+
+def scenario_refresh_collapsed(ctx):
+    # Like refresh_unchanged, with all groups collapsed in the palette. Last,
+    # as the groups are left collapsed.
+    groups = [group._name for group in ctx.design.timeline._timelineGroups._items]
+    def setup():
+        ctx.send_from_html('setCollapsedGroups', { 'names': groups })
+    def run():
+        ctx.addin.invalidate()
+    return setup, run
+
+SCENARIOS = {
+    'build_timeline_tree': scenario_build_timeline_tree,
+    'component_hierarchy': scenario_component_hierarchy,
+    'open': scenario_open,
+    'open_cached': scenario_open_cached,
+    'refresh_unchanged': scenario_refresh_unchanged,
+    'refresh_renamed': scenario_refresh_renamed,
+    'roll_to': scenario_roll_to,
+    'rename': scenario_rename,
+    'select': scenario_select,
+    'select_many': scenario_select_many,
+    'feature_details': scenario_feature_details,
+    'new_command': scenario_new_command,
+    'known_command': scenario_known_command,
+    'switch_document': scenario_switch_document,
+    'refresh_collapsed': scenario_refresh_collapsed,
+}
+
+####################################################################
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def measure(ctx, setup, run, repeat):
+    times = []
+    calls = 0
+    json_bytes = 0
+    for _ in range(repeat):
+        if setup:
+            setup()
+        ctx.palette.sent.clear()
+        adsk.core.reset_call_counts()
+
+        start = time.perf_counter()
+        return_data = run()
+        times.append(time.perf_counter() - start)
+
+        calls += sum(adsk.core.call_counts.values())
+        json_bytes += len(return_data or '') + sum(len(data) for _, data in ctx.palette.sent)
+
+    # tracemalloc slows everything down, so it gets a run of its own
+    if setup:
+        setup()
+    tracemalloc.start()
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        'p50_ms': percentile(times, 0.5) * 1000,
+        'p90_ms': percentile(times, 0.9) * 1000,
+        'p99_ms': percentile(times, 0.99) * 1000,
+        'max_ms': times[-1] * 1000,
+        'adsk_calls': calls // repeat,
+        'json_bytes': json_bytes // repeat,
+        'peak_kib': peak_memory // 1024,
+    }
+
+def start_addin(addin):
+    '''Runs the add-in and opens the palette. Returns the startup result.
+    The add-in times its own module load and run(), so there is one sample.'''
+    adsk.core.reset_call_counts()
+    addin.run(None)
+    calls = sum(adsk.core.call_counts.values())
+    startup_ms = addin.startup_timing['import-ms'] + addin.startup_timing['run-ms']
+
+    addin.show_palette()
+    palette = adsk.core.Application.get().userInterface.palettes.itemById(PALETTE_ID)
+    palette.send_from_html('ready', '{}')
+
+    return {
+        'scenario': 'startup',
+        'size': 0,
+        'group_ratio': 0,
+        'p50_ms': startup_ms,
+        'p90_ms': startup_ms,
+        'p99_ms': startup_ms,
+        'max_ms': startup_ms,
+        'adsk_calls': calls,
+        'json_bytes': 0,
+        'peak_kib': 0,
+    }
+
+def run_benchmark(args):
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    cache_dir = tempfile.TemporaryDirectory(prefix='VerticalTimeline-benchmark-')
+    try:
+        addin = load_addin()
+        # Not in the add-in directory
+        addin.disk_cache.path = cache_dir.name
+        # The palette is loaded for an empty document, like at startup
+        startup_result = start_addin(addin)
+        print_result(startup_result, stdout)
+
+        results = [startup_result]
+        for size in args.sizes:
+            for group_ratio in args.group_ratios:
+                spec = synthetic.TimelineSpec(count=size, group_ratio=group_ratio)
+                for key in SPEC_ARGUMENTS:
+                    setattr(spec, key, getattr(args, key))
+                ctx = Context(addin, spec)
+                # Get the palette in sync with the design
+                ctx.send_from_html('ready')
+                ctx.app.process_events()
+
+                for name in args.scenarios:
+                    setup, run = SCENARIOS[name](ctx)
+                    result = measure(ctx, setup, run, args.repeat)
+                    # Finish what the scenario left to the event loop
+                    ctx.app.process_events()
+                    result.update(scenario=name, size=size, group_ratio=group_ratio)
+                    results.append(result)
+                    print_result(result, stdout)
+    finally:
+        sys.stdout = stdout
+        cache_dir.cleanup()
+    return results
+
+# Name, width and format
+COLUMNS = [
+    ('scenario', 20, ''),
+    ('size', 6, ''),
+    ('group_ratio', 11, ''),
+    ('p50_ms', 9, '.2f'),
+    ('p90_ms', 9, '.2f'),
+    ('p99_ms', 9, '.2f'),
+    ('max_ms', 9, '.2f'),
+    ('adsk_calls', 10, ''),
+    ('json_bytes', 10, ''),
+    ('peak_kib', 8, ''),
+]
+
+def print_header(file):
+    header = [f'{name[:width]:{"<" if i == 0 else ">"}{width}}'
+              for i, (name, width, _) in enumerate(COLUMNS)]
+    print(' '.join(header), file=file)
+
+def print_result(result, file):
+    fields = [f'{result[name]:{"<" if i == 0 else ">"}{width}{fmt}}'
+              for i, (name, width, fmt) in enumerate(COLUMNS)]
+    print(' '.join(fields), file=file, flush=True)
+
+# TimelineSpec parameters that are the same for all runs
+SPEC_ARGUMENTS = [key for key in vars(synthetic.TimelineSpec()) if key not in ('count', 'group_ratio')]
+
+def comma_list(item_type):
+    return lambda value: [item_type(item) for item in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=comma_list(int), default=[100, 1000, 10000],
+                        help='Numbers of timeline objects (default: 100,1000,10000)')
+    parser.add_argument('--group-ratios', type=comma_list(float), default=[0.01],
+                        help='Chances of starting a group, per object (default: 0.01)')
+    parser.add_argument('--scenarios', type=comma_list(str), default=list(SCENARIOS),
+                        help='Scenarios to run (default: all). One of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timed runs per scenario (default: 5)')
+    parser.add_argument('--api-latency-us', type=float, default=0,
+                        help='Time added to each adsk call, to mimic Fusion (default: 0)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the results to FILE, for comparisons')
+    for key in SPEC_ARGUMENTS:
+        default = getattr(synthetic.TimelineSpec(), key)
+        parser.add_argument('--' + key.replace('_', '-'), type=type(default), default=default,
+                            help=f'Synthetic timeline parameter (default: {default})')
+    args = parser.parse_args()
+
+    unknown_scenarios = set(args.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error('Unknown scenarios: ' + ', '.join(sorted(unknown_scenarios)))
+
+    adsk.core.call_latency = args.api_latency_us / 1e6
+
+    print_header(sys.stdout)
+    try:
+        results = run_benchmark(args)
+    except BenchmarkError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'args': vars(args), 'results': results }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
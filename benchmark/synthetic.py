@@ -0,0 +1,187 @@
+# This file is part of VerticalTimeline, a Fusion 360 add-in that
+# provides a vertical timeline.
+#
+# Copyright (C) 2020  Thomas Axelsson
+#
+# This work is dual-licensed under GPL 3.0 (or any later version) and MIT.
+# You can choose between one of them if you use this work.
+
+# Generates synthetic designs for the benchmark, using the adsk stand-in.
+
+import random
+
+import adsk.core, adsk.fusion
+
+# Feature types and how common they are
+FEATURE_WEIGHTS = [
+    ('Sketch', 25),
+    ('ExtrudeFeature', 25),
+    ('FilletFeature', 10),
+    ('ChamferFeature', 5),
+    ('HoleFeature', 5),
+    ('RevolveFeature', 4),
+    ('ShellFeature', 2),
+    ('CombineFeature', 4),
+    ('RectangularPatternFeature', 3),
+    ('MirrorFeature', 3),
+    ('SplitBodyFeature', 2),
+    ('BoxFeature', 2),
+    ('ConstructionPlane', 5),
+    ('Joint', 5),
+]
+
+# Names of features that Fusion does not give entity access to
+ACCESS_ERROR_NAMES = ['Move', 'Align', 'Derived from ']
+
+class TimelineSpec:
+    '''Parameters for a synthetic design. Ratios are per timeline object.'''
+    def __init__(self, count=1000,
+                 group_ratio=0.01, group_size=10, group_depth=1,
+                 occurrence_ratio=0.05, occurrence_depth=3,
+                 suppressed_ratio=0.02, rolled_back_ratio=0.1,
+                 access_error_ratio=0.02, seed=0):
+        self.count = count
+        # Chance of starting a group, at the top level
+        self.group_ratio = group_ratio
+        # Average number of objects in a group
+        self.group_size = group_size
+        # Maximum nesting of groups
+        self.group_depth = group_depth
+        self.occurrence_ratio = occurrence_ratio
+        # Maximum depth of the component tree
+        self.occurrence_depth = occurrence_depth
+        self.suppressed_ratio = suppressed_ratio
+        self.rolled_back_ratio = rolled_back_ratio
+        self.access_error_ratio = access_error_ratio
+        self.seed = seed
+
+    def __str__(self):
+        return ' '.join(f'{key}={value}' for key, value in vars(self).items())
+
+def build_design(spec):
+    '''Returns a design with a timeline of spec.count objects, not counting
+    the groups.'''
+    rng = random.Random(spec.seed)
+    design = adsk.fusion.Design()
+    design._parentDocument = adsk.core.Document(
+        f'Design {spec.count} {spec.seed}', adsk.core.DataFile(f'datafile-{spec}'))
+    root = adsk.fusion.Component(design, 'Root', 'component-0')
+    design._rootComponent = root
+    design._allComponents._items.append(root)
+    timeline = adsk.fusion.Timeline()
+    design._timeline = timeline
+
+    # (component, depth)
+    components = [(root, 0)]
+    feature_types = [name for name, _ in FEATURE_WEIGHTS]
+    feature_weights = [weight for _, weight in FEATURE_WEIGHTS]
+    names = {}
+    def next_name(prefix):
+        names[prefix] = names.get(prefix, 0) + 1
+        return f'{prefix}{names[prefix]}'
+
+    def new_occurrence():
+        # New components are mostly added under a recent component
+        parent, depth = rng.choice(components[-10:])
+        if depth >= spec.occurrence_depth:
+            parent, depth = root, 0
+        component = adsk.fusion.Component(design, next_name('Component'),
+                                          f'component-{len(components)}')
+        occurrence = adsk.fusion.Occurrence(component, parent,
+                                            f'occurrence-{len(components)}')
+        parent._occurrences._items.append(occurrence)
+        root._allOccurrences._items.append(occurrence)
+        design._allComponents._items.append(component)
+        components.append((component, depth + 1))
+        return occurrence
+
+    def new_feature():
+        component, _ = rng.choice(components[-10:])
+        feature_type = rng.choices(feature_types, feature_weights)[0]
+        name = next_name(feature_type.replace('Feature', ''))
+        if feature_type == 'ConstructionPlane':
+            return adsk.fusion.ConstructionPlane(
+                name, component, adsk.fusion.ConstructionPlaneOffsetDefinition())
+        entity_class = getattr(adsk.fusion, feature_type)
+        entity = entity_class(name, component)
+        if isinstance(entity, adsk.fusion.Feature):
+            entity._isSolid = rng.random() < 0.9
+        return entity
+
+    def new_object():
+        if rng.random() < spec.access_error_ratio:
+            prefix = rng.choice(ACCESS_ERROR_NAMES)
+            if prefix == 'Derived from ':
+                name = prefix + next_name('Design')
+            else:
+                name = next_name(prefix)
+            obj = adsk.fusion.TimelineObject(timeline, name,
+                                             RuntimeError('3 : object does not exist'))
+        elif rng.random() < spec.occurrence_ratio:
+            occurrence = new_occurrence()
+            # Fusion separates an empty prefix with a space
+            obj = adsk.fusion.TimelineObject(timeline, ' ' + occurrence._name, occurrence)
+        else:
+            entity = new_feature()
+            obj = adsk.fusion.TimelineObject(timeline, entity._name, entity)
+        obj._isSuppressed = rng.random() < spec.suppressed_ratio
+        timeline.features.append(obj)
+        return obj
+
+    def new_group(parent, depth, size):
+        group = adsk.fusion.TimelineGroup(timeline, next_name('Group'))
+        group._parentGroup = parent
+        timeline._timelineGroups._items.append(group)
+        while len(group.children) < size and len(timeline.features) < spec.count:
+            if depth < spec.group_depth and rng.random() < 0.1:
+                child = new_group(group, depth + 1, rng.randint(1, 2 * spec.group_size))
+            else:
+                child = new_object()
+                child._parentGroup = group
+            group.children.append(child)
+        return group
+
+    while len(timeline.features) < spec.count:
+        if rng.random() < spec.group_ratio:
+            obj = new_group(None, 1, rng.randint(1, 2 * spec.group_size))
+        else:
+            obj = new_object()
+        timeline._items.append(obj)
+
+    prune_empty_groups(timeline)
+
+    for index, obj in enumerate(flatten(timeline._items)):
+        obj._index = index
+
+    timeline._markerPosition = round(spec.count * (1 - spec.rolled_back_ratio))
+    timeline.update_rolled_back()
+
+    return design
+
+def prune_empty_groups(timeline):
+    # A group can end up empty if the object count is reached
+    def prune(objects):
+        kept = []
+        for obj in objects:
+            if obj._isGroup:
+                obj.children = prune(obj.children)
+                if not obj.children:
+                    continue
+            kept.append(obj)
+        return kept
+    timeline._items = prune(timeline._items)
+    groups = timeline._timelineGroups._items
+    timeline._timelineGroups._items = [group for group in groups if group.children]
+
+def flatten(objects):
+    flat = []
+    for obj in objects:
+        flat.append(obj)
+        if obj._isGroup:
+            flat.extend(flatten(obj.children))
+    return flat
+
+def set_active_design(design):
+    app = adsk.core.Application.get()
+    app._activeProduct = design
+    app._activeDocument = design._parentDocument